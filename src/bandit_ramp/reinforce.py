@@ -4,42 +4,110 @@ import torch
 def sample(likelihoods: torch.Tensor, num_samples: int, sample_size: int) -> (
     tuple[torch.Tensor, torch.Tensor]
 ):
-    """Generate `num_samples` samples from Plackett-Luce distribution defined by `likelihoods`."""
+    """Generate `num_samples` samples from Plackett-Luce distribution defined by `likelihoods`.
+
+    Samples are drawn at once with the Gumbel-top-k trick: the top `sample_size` items of log-likelihoods
+    perturbed by Gumbel noise follow the Plackett-Luce distribution. Log-probabilities are differentiable
+    with respect to `likelihoods`.
+    """
     valid_cnt = (likelihoods > 0).sum(dim=1).min().item()
     sample_size = min(sample_size, valid_cnt)
 
-    indices = []
-    logps = []
+    log_likelihoods = _log(likelihoods).unsqueeze(dim=1).expand(-1, num_samples, -1)
 
-    for _ in range(num_samples):
-        sample_indices, sample_logp = _sample_without_replacement(likelihoods, sample_size)
-        indices.append(sample_indices)
-        logps.append(sample_logp)
+    gumbels = -torch.empty_like(log_likelihoods).exponential_().log()
+    _, indices = (log_likelihoods.detach() + gumbels).topk(sample_size, dim=2)
 
-    indices = torch.stack(indices, dim=1)
-    logps = torch.stack(logps, dim=1)
+    logps = _compute_logps(log_likelihoods, indices)
     return indices, logps
 
 
-def _sample_without_replacement(likelihoods: torch.Tensor, sample_size: int) -> (
-    tuple[torch.Tensor, torch.Tensor]
+def sample_unique(likelihoods: torch.Tensor, num_samples: int, sample_size: int) -> (
+    tuple[torch.Tensor, torch.Tensor, torch.Tensor]
 ):
-    """Generate sample of `sample_size` items from Plackett-Luce distribution defined by `likelihoods`."""
-    indices = torch.full_like(likelihoods[:, :sample_size], fill_value=-1, dtype=torch.long)
-    logps = torch.zeros_like(likelihoods[:, :sample_size], dtype=torch.float)
+    """Generate `num_samples` distinct samples from Plackett-Luce distribution defined by `likelihoods`,
+    along with their importance weights."""
+    valid_cnt = (likelihoods > 0).sum(dim=1).min().item()
+    sample_size = min(sample_size, valid_cnt)
+    batch_size, num_items = likelihoods.shape
+    # Stochastic beam search keeps the samples of highest Gumbel-perturbed log-probability, plus one more whose
+    # perturbed log-probability is the threshold for the importance weights
+    beam_size = num_samples + 1
+
+    log_likelihoods = _log(likelihoods)
+    beam_indices = torch.zeros(batch_size, beam_size, 0, dtype=torch.long, device=likelihoods.device)
+    # Start from the empty sample of probability 1, with a perturbed log-probability of a standard Gumbel
+    beam_logps = torch.full((batch_size, beam_size), float('-inf'), device=likelihoods.device)
+    beam_logps[:, 0] = 0.
+    beam_keys = beam_logps.clone()
+    beam_keys[:, 0] = -torch.empty(batch_size, device=likelihoods.device).exponential_().log()
+
+    for _ in range(sample_size):
+        # Extend every sample by every item not in it yet
+        item_log_likelihoods = log_likelihoods.detach().unsqueeze(dim=1).expand(-1, beam_size, -1).scatter(
+            dim=2, index=beam_indices, value=float('-inf')
+        )
+        logps = beam_logps.unsqueeze(dim=2) + item_log_likelihoods.log_softmax(dim=2)
+        keys = _perturb(logps, beam_keys.unsqueeze(dim=2))
+
+        beam_keys, top_indices = keys.view(batch_size, -1).topk(beam_size, dim=1)
+        beam_logps = logps.view(batch_size, -1).gather(dim=1, index=top_indices)
+        parent_indices = (top_indices // num_items).unsqueeze(dim=2).expand_as(beam_indices)
+        beam_indices = torch.cat([
+            beam_indices.gather(dim=1, index=parent_indices),
+            (top_indices % num_items).unsqueeze(dim=2)
+        ], dim=2)
+
+    indices = beam_indices[:, :num_samples]
+    valid_mask = beam_logps[:, :num_samples] > float('-inf')
+    # Fill in nonexistent samples with the first one, which always exists, to keep log-probabilities finite
+    indices = torch.where(valid_mask.unsqueeze(dim=2), indices, indices[:, :1])
+
+    # Priority sampling: weighting each sample by its probability over that of its perturbed log-probability
+    # exceeding the threshold makes the weighted sum unbiased. That probability is 1 if the threshold is -inf,
+    # i.e. all distinct samples were drawn, and nonexistent samples get zero weight
+    threshold = beam_keys[:, num_samples:]
+    inclusion_probs = -torch.expm1(-torch.exp(beam_logps[:, :num_samples] - threshold))
+    weights = torch.where(valid_mask, beam_logps[:, :num_samples].exp() / inclusion_probs, 0.)
+
+    logps = _compute_logps(log_likelihoods.unsqueeze(dim=1).expand(-1, num_samples, -1), indices)
+    return indices, logps, weights
 
-    for i in range(sample_size):
-        # Sample based on `likelihoods`
-        probs = likelihoods / likelihoods.sum(dim=1, keepdim=True)
-        item_indices = torch.multinomial(probs, num_samples=1)
-        item_probs = probs.gather(dim=1, index=item_indices)
 
-        indices[:, i] = item_indices.squeeze(dim=1)
-        logps[:, i] = torch.log(item_probs).squeeze(dim=1)
-        likelihoods = likelihoods.scatter(dim=1, index=item_indices, value=0.)
+def _log(likelihoods: torch.Tensor) -> torch.Tensor:
+    # Replace zero likelihoods before taking the log, so that they get zero rather than NaN gradients
+    valid_mask = likelihoods > 0
+    return torch.where(valid_mask, likelihoods, 1.).log().masked_fill(~valid_mask, float('-inf'))
 
-    logp = logps.sum(dim=1)
-    return indices, logp
+
+def _perturb(logps: torch.Tensor, parent_keys: torch.Tensor) -> torch.Tensor:
+    """Perturb the log-probabilities of the children of samples with Gumbel noise, conditioned on their
+    maximum being the perturbed log-probability of the parent, `parent_keys`."""
+    keys = logps - torch.empty_like(logps).exponential_().log()
+    max_keys = keys.max(dim=2, keepdim=True).values
+
+    # Numerically stable form of -log(exp(-parent_keys) - exp(-max_keys) + exp(-keys))
+    diffs = parent_keys - keys + _log1mexp(keys - max_keys)
+    keys = parent_keys - diffs.clamp(min=0.) - torch.log1p(torch.exp(-diffs.abs()))
+    return keys.masked_fill(logps == float('-inf'), float('-inf'))
+
+
+def _log1mexp(x: torch.Tensor) -> torch.Tensor:
+    """Compute log(1 - exp(x)) for x <= 0."""
+    return torch.where(x > -0.6931, torch.log(-torch.expm1(x)), torch.log1p(-torch.exp(x)))
+
+
+def _compute_logps(log_likelihoods: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """Compute the Plackett-Luce log-probabilities of the ordered samples `indices`."""
+    item_log_likelihoods = log_likelihoods.gather(dim=2, index=indices)
+    rest_log_likelihood = log_likelihoods.scatter(
+        dim=2, index=indices, value=float('-inf')
+    ).logsumexp(dim=2, keepdim=True)
+
+    # The i-th item is drawn from itself, the items drawn after it, and the items never drawn
+    remaining_log_likelihoods = torch.cat([item_log_likelihoods, rest_log_likelihood], dim=2)
+    normalizers = remaining_log_likelihoods.flip(dims=[2]).logcumsumexp(dim=2).flip(dims=[2])[:, :, :-1]
+    return torch.sum(item_log_likelihoods - normalizers, dim=2)
 
 
 def compute_loss(logps: torch.Tensor, rewards: torch.Tensor) -> torch.Tensor:
@@ -47,3 +115,11 @@ def compute_loss(logps: torch.Tensor, rewards: torch.Tensor) -> torch.Tensor:
     mean = rewards.mean(dim=1, keepdim=True)
     std = rewards.std(dim=1, keepdim=True)
     return -torch.mean(logps * (rewards - mean) / (std + 1e-9))
+
+
+def compute_weighted_loss(logps: torch.Tensor, rewards: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+    """Compute REINFORCE loss of samples from `sample_unique`, weighted by their importance weights."""
+    normalized_weights = weights / weights.sum(dim=1, keepdim=True)
+    mean = torch.sum(normalized_weights * rewards, dim=1, keepdim=True)
+    std = torch.sum(normalized_weights * (rewards - mean) ** 2, dim=1, keepdim=True).sqrt()
+    return -torch.mean(torch.sum(weights * logps * (rewards - mean) / (std + 1e-9), dim=1))
@@ -48,7 +48,7 @@ class Trainer:
             lr=self.cfg.lr
         )
 
-        self.device = torch.device('cuda')
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.score_model.to(self.device)
 
         if from_pretrained:
@@ -98,17 +98,31 @@ class Trainer:
                     batch['corpus_inputs'],
                     batch['profile_mask']
                 )
-                reranked_indices, logps = reinforce.sample(
-                    likelihoods,
-                    self.cfg.reinforce.num_samples,
-                    self.cfg.num_rerank
-                )
 
+                if self.cfg.reinforce.unique:
+                    reranked_indices, logps, weights = reinforce.sample_unique(
+                        likelihoods,
+                        self.cfg.reinforce.num_samples,
+                        self.cfg.num_rerank
+                    )
+                else:
+                    reranked_indices, logps = reinforce.sample(
+                        likelihoods,
+                        self.cfg.reinforce.num_samples,
+                        self.cfg.num_rerank
+                    )
+                    weights = torch.ones_like(logps)
+
+                sample_mask = weights > 0
                 prompts = []
                 targets = []
 
                 for batch_index, batch_reranked_indices in enumerate(reranked_indices):
-                    for sample_reranked_indices in batch_reranked_indices:
+                    for sample_index, sample_reranked_indices in enumerate(batch_reranked_indices):
+                        # Samples of zero weight do not exist, when there are fewer distinct ones than requested
+                        if not sample_mask[batch_index, sample_index]:
+                            continue
+
                         profiles = [
                             batch['profiles'][batch_index][reranked_index]
                             for reranked_index in sample_reranked_indices
@@ -127,8 +141,15 @@ class Trainer:
                 else:
                     raise ValueError(f'Invalid reward: {self.cfg.reinforce.reward}')
 
-                rewards = rewards.to(self.device).view_as(logps)
-                loss = reinforce.compute_loss(logps, rewards)
+                rewards = logps.new_zeros(logps.shape).masked_scatter(
+                    sample_mask, rewards.to(self.device, logps.dtype)
+                )
+
+                if self.cfg.reinforce.unique:
+                    loss = reinforce.compute_weighted_loss(logps, rewards, weights)
+                else:
+                    loss = reinforce.compute_loss(logps, rewards)
+
                 loss /= self.cfg.gradient_accumulation_steps
                 loss.backward()
 
@@ -139,7 +160,9 @@ class Trainer:
 
                 start_flag = False
                 self.example_cnt += len(batch['source'])
-                self.wandb.log({'reward': rewards.mean().item(), 'loss': loss.item()})
+                logs = {'reward': rewards[sample_mask].mean().item(), 'loss': loss.item()}
+                logs.update({f'llm/{key}': value for key, value in self.llm.stats().items()})
+                self.wandb.log(logs)
 
             self.epoch += 1
 
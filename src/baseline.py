@@ -4,6 +4,7 @@ import logging
 import os
 import random
 import time
+from pathlib import Path
 
 import nltk
 import numpy as np
@@ -13,11 +14,12 @@ import torch
 from transformers import AutoTokenizer
 
 import hydra
+from hydra.core.hydra_config import HydraConfig
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
 
 from bandit_ramp import load_retrieved_lamp_dataset
-from lamp import create_metric, create_prompt_generator
+from lamp import LABELED_TASKS, create_metric, create_prompt_generator, get_labels
 from lamp.data_types import PromptGenerator
 from lamp.retrievers import Contriever
 from llm import LLM
@@ -89,7 +91,9 @@ def replug(cfg: DictConfig, dataset: Dataset, prompt_generator: PromptGenerator)
 ):
     contriever = Contriever()
 
-    if cfg.llm.provider == 'local':
+    # Configs of local models (including those behind a daemon) use the parameters of Hugging Face `generate`,
+    # and those of servers the parameters of the OpenAI-compatible API
+    if 'max_new_tokens' in cfg.llm.generate_config:
         OmegaConf.set_struct(cfg.llm.generate_config, False)
         cfg.llm.generate_config.update({
             'batch_size': 1,
@@ -100,13 +104,13 @@ def replug(cfg: DictConfig, dataset: Dataset, prompt_generator: PromptGenerator)
             'num_return_sequences': 4
         })
         OmegaConf.set_struct(cfg.llm.generate_config, True)
-    elif cfg.llm.provider == 'vllm':
+    else:
         # Use sampling instead of beam search
         OmegaConf.set_struct(cfg.llm.generate_config, False)
         cfg.llm.generate_config.update({'n': 4})
         OmegaConf.set_struct(cfg.llm.generate_config, True)
 
-    llm = LLM(cfg.task, **cfg.llm)
+    llm = LLM(cfg.task, **cfg.llm, labels=(get_labels(cfg.task) if cfg.task in LABELED_TASKS else None))
 
     predictions = []
     targets = []
@@ -133,6 +137,7 @@ def replug(cfg: DictConfig, dataset: Dataset, prompt_generator: PromptGenerator)
         predictions.append(prediction)
         targets.append(example['target'])
 
+    _dump_llm_stats(llm)
     return predictions, targets
 
 
@@ -144,20 +149,22 @@ def icralm(cfg: DictConfig, dataset: Dataset, prompt_generator: PromptGenerator)
 
     contriever = Contriever()
 
-    # Get the original maximum new tokens and set it to 1
-    if cfg.llm.provider == 'local':
+    # Get the original maximum new tokens and set it to 1, in whichever parameter the config uses
+    if 'max_new_tokens' in cfg.llm.generate_config:
         max_new_tokens = cfg.llm.generate_config.max_new_tokens
         OmegaConf.set_struct(cfg.llm.generate_config, False)
         cfg.llm.generate_config.update({'max_new_tokens': 1})
         OmegaConf.set_struct(cfg.llm.generate_config, True)
-    elif cfg.llm.provider == 'vllm':
-        max_new_tokens = cfg.llm.generate_config.max_completion_tokens
-        del cfg.llm.generate_config.max_completion_tokens
+    else:
+        max_new_tokens = cfg.llm.generate_config.get(
+            'max_completion_tokens', cfg.llm.generate_config.get('max_tokens')
+        )
         OmegaConf.set_struct(cfg.llm.generate_config, False)
+        cfg.llm.generate_config.pop('max_completion_tokens', None)
         cfg.llm.generate_config.update({'max_tokens': 1})
         OmegaConf.set_struct(cfg.llm.generate_config, True)
 
-    llm = LLM(cfg.task, **cfg.llm)
+    llm = LLM(cfg.task, **cfg.llm, labels=(get_labels(cfg.task) if cfg.task in LABELED_TASKS else None))
 
     predictions = []
     targets = []
@@ -202,6 +209,7 @@ def icralm(cfg: DictConfig, dataset: Dataset, prompt_generator: PromptGenerator)
         predictions.append(prediction)
         targets.append(example['target'])
 
+    _dump_llm_stats(llm)
     return predictions, targets
 
 
@@ -216,10 +224,27 @@ def reranker(cfg: DictConfig, dataset: Dataset, prompt_generator: PromptGenerato
         prompts.append(prompt)
         targets.append(example['target'])
 
-    llm = LLM(cfg.task, **cfg.llm)
-    predictions = llm.generate(prompts, verbose=True)
+    llm = LLM(cfg.task, **cfg.llm, labels=(get_labels(cfg.task) if cfg.task in LABELED_TASKS else None))
+    predictions = [None] * len(prompts)
+    output_path = Path(HydraConfig.get().runtime.output_dir) / 'predictions.jsonl'
+
+    # Write predictions as they complete, so that finished ones survive a crash
+    with open(output_path, 'w') as f, tqdm(total=len(prompts), desc='Generating responses') as pbar:
+        for index, prediction in llm.stream_generate(prompts):
+            predictions[index] = prediction
+            f.write(json.dumps({'index': index, 'prediction': prediction, 'target': targets[index]}) + '\n')
+            f.flush()
+            pbar.update(1)
+
+    _dump_llm_stats(llm)
     return predictions, targets
 
 
+def _dump_llm_stats(llm: LLM) -> None:
+    # Call telemetry shows where the run spent its time, next to the wall-clock total logged by main
+    with open(Path(HydraConfig.get().runtime.output_dir) / 'llm_stats.json', 'w') as f:
+        json.dump(llm.stats(), f, indent=2)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,473 @@
+import asyncio
+import copy
+import itertools
+import time
+from typing import Callable
+
+import torch
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, LlamaConfig, LlamaForCausalLM, PreTrainedModel, PreTrainedTokenizerBase
+)
+
+import fire
+from omegaconf import OmegaConf
+
+from bandit_ramp import reinforce
+from llm import LLM
+
+from llm.batching import left_pad
+from llm.recording import load_recording
+from llm.speculative_decoding import SpeculativeDecoder
+from llm.stand_in_server import StandInServer
+from llm.static_decoding import StaticDecoder
+
+
+def static_cache(
+    model: str | None = None, device: str = 'cpu', batch_size: int = 4, prompt_length: int = 96,
+    max_new_tokens: int = 64, num_batches: int = 4
+) -> None:
+    """Compare decoding throughput of `generate` with a dynamic cache against the static cache path, with and
+    without compilation. Without `model`, a randomly initialized tiny Llama is used."""
+    model = _load_model(model, device)
+    prompts_ids = _create_prompts(model, batch_size * num_batches, prompt_length)
+    generate_config = {'do_sample': False, 'max_new_tokens': max_new_tokens}
+
+    def _generate_dynamic() -> int:
+        num_tokens = 0
+
+        for start in range(0, len(prompts_ids), batch_size):
+            input_ids, attention_mask, _ = left_pad(prompts_ids[start:start + batch_size], 0, model.device)
+
+            with torch.no_grad():
+                outputs_ids = model.generate(
+                    input_ids=input_ids, attention_mask=attention_mask, **generate_config
+                )
+
+            num_tokens += outputs_ids[:, input_ids.shape[1]:].numel()
+
+        return num_tokens
+
+    print(f'dynamic cache: {_measure(_generate_dynamic):.1f} tokens/s')
+
+    for compile in [False, True]:
+        decoder = StaticDecoder(model, 0, batch_size, max_new_tokens, [prompt_length], compile)
+        start_time = time.perf_counter()
+        decoder.warmup(generate_config)
+        warmup_time = time.perf_counter() - start_time
+
+        def _generate_static() -> int:
+            completions_ids = decoder.generate(prompts_ids, [], generate_config)
+            return sum(len(completion_ids) for all_ids in completions_ids for completion_ids in all_ids)
+
+        name = 'static cache + compile' if compile else 'static cache'
+        print(f'{name}: {_measure(_generate_static):.1f} tokens/s (warmup {warmup_time:.1f}s)')
+
+
+def speculative(
+    model: str | None = None, draft_model: str | None = None, device: str = 'cpu', num_draft_tokens: int = 4,
+    prompt_length: int = 96, max_new_tokens: int = 64, num_prompts: int = 8
+) -> None:
+    """Compare greedy decoding throughput of `generate` against speculative decoding.
+
+    Without `model` and `draft_model`, a randomly initialized Llama is used whose layers but the first are
+    damped, and the draft model is that first layer alone. Like a real draft model, it then agrees with the
+    target model on most tokens at a fraction of its cost.
+    """
+    if model is None and draft_model is None:
+        model = _load_model(
+            None, device,
+            hidden_size=1024, intermediate_size=2752, num_hidden_layers=12, num_attention_heads=16,
+            num_key_value_heads=4
+        )
+
+        with torch.no_grad():
+            for layer in model.model.layers[1:]:
+                layer.self_attn.o_proj.weight.mul_(0.01)
+                layer.mlp.down_proj.weight.mul_(0.01)
+
+        draft_model = copy.deepcopy(model)
+        draft_model.model.layers = draft_model.model.layers[:1]
+        draft_model.config.num_hidden_layers = 1
+    else:
+        model = _load_model(model, device)
+        draft_model = _load_model(draft_model, device)
+
+    prompts_ids = _create_prompts(model, num_prompts, prompt_length)
+    generate_config = {'do_sample': False, 'max_new_tokens': max_new_tokens}
+
+    def _generate_target() -> int:
+        num_tokens = 0
+
+        # Speculative decoding runs one sequence at a time, so compare against the same batch size
+        for prompt_ids in prompts_ids:
+            with torch.no_grad():
+                outputs_ids = model.generate(
+                    input_ids=torch.tensor([prompt_ids], device=model.device), **generate_config
+                )
+
+            num_tokens += outputs_ids.shape[1] - len(prompt_ids)
+
+        return num_tokens
+
+    decoder = SpeculativeDecoder(model, draft_model, num_draft_tokens)
+
+    def _generate_speculative() -> int:
+        completions_ids = decoder.generate(prompts_ids, [], generate_config)
+        return sum(len(completion_ids) for all_ids in completions_ids for completion_ids in all_ids)
+
+    target_throughput = _measure(_generate_target)
+    speculative_throughput = _measure(_generate_speculative)
+    stats = decoder.stats()
+    print(f'target model: {target_throughput:.1f} tokens/s')
+    print(
+        f'speculative: {speculative_throughput:.1f} tokens/s '
+        f'(speedup {speculative_throughput / target_throughput:.2f}x)'
+    )
+    print(
+        f'draft acceptance rate: {stats["draft_acceptance_rate"]:.2f}, '
+        f'tokens per target step: {stats["tokens_per_target_step"]:.2f}'
+    )
+
+
+def cpu(
+    model: str = 'Qwen/Qwen2.5-0.5B-Instruct', task: str = 'LaMP-4', num_threads: int | None = None,
+    batch_size: int = 4, prompt_length: int = 96, target_length: int = 16, max_new_tokens: int = 32,
+    num_prompts: int = 8
+) -> None:
+    """Compare the throughput of `LLM.generate` and `LLM.compute_target_logps` of the local provider on CPU in
+    float32, bfloat16 and with int8 dynamic quantization, along with the drift of target log-probs from
+    float32, i.e. the calls of a reward loop without accelerators."""
+    reference_logps = None
+    prompts = targets = None
+
+    for cpu_config in [{'dtype': 'float32'}, {'dtype': 'bfloat16'}, {'quantization': 'int8'}]:
+        name = cpu_config.get('quantization') or cpu_config['dtype']
+        llm = LLM(
+            task, model, 'local', None,
+            {'batch_size': batch_size, 'max_new_tokens': max_new_tokens, 'do_sample': False},
+            device='cpu', cpu_config={**cpu_config, 'num_threads': num_threads}
+        )
+
+        if name == 'bfloat16' and llm.pipeline.model.dtype != torch.bfloat16:
+            continue
+
+        if prompts is None:
+            prompts = _create_texts(llm.tokenizer, num_prompts, prompt_length)
+            targets = _create_texts(llm.tokenizer, num_prompts, target_length)
+
+        def _generate() -> int:
+            return sum(llm._count_tokens(llm.generate(prompts)))
+
+        all_logps = []
+
+        def _score() -> int:
+            all_logps.append(llm.compute_target_logps(prompts, targets))
+            return sum(llm._count_tokens(prompts)) + sum(llm._count_tokens(targets))
+
+        generate_throughput = _measure(_generate)
+        score_throughput = _measure(_score)
+        logps = all_logps[0]
+        reference_logps = logps if reference_logps is None else reference_logps
+        print(
+            f'{name}: generate {generate_throughput:.1f} tokens/s, score {score_throughput:.1f} tokens/s, '
+            f'max log-prob drift {(logps - reference_logps).abs().max().item():.4f}'
+        )
+
+
+def replay(
+    recording: str, llm_config: str | None = None, speed: float | None = 1., max_calls: int | None = None,
+    **server_config
+) -> None:
+    """Replay the calls of a recording (see `record_path` of `LLM`) through an API `LLM` against a stand-in
+    server, and report client-side throughput, latency, concurrency and event-loop lag.
+
+    Calls are sent at their recorded arrival times divided by `speed`, or one after another if `speed` is
+    None. Client settings such as `concurrency_config` and `generate_config` are read from the `llm_config`
+    YAML file, and `server_config` is passed to `StandInServer` (e.g. `--time_per_output_token=0.01`).
+    Responses have the recorded lengths unless `response_lengths` is given.
+    """
+    header, calls = load_recording(recording)
+    calls = calls[:max_calls]
+    config = OmegaConf.to_container(OmegaConf.load(llm_config)) if llm_config is not None else {}
+    # The stand-in server replaces the model and endpoints of the config
+    config.pop('model', None)
+    config.pop('endpoint', None)
+    config.update({'provider': 'vllm', 'completion_cache': None, 'record_path': None, 'token_telemetry': True})
+    config['generate_config'] = _to_api_generate_config(
+        config.get('generate_config', header['generate_config'])
+    )
+    server_config.setdefault('response_lengths', [
+        length for call in calls if call['method'] == 'generate' for length in call['response_lengths']
+    ])
+
+    server = StandInServer(tokenizer=AutoTokenizer.from_pretrained(header['model']), **server_config).start()
+    llm = LLM(header['task'], header['model'], endpoint=server.address, **config)
+    loop_lags = []
+
+    async def _monitor_loop(interval: float = 0.01) -> None:
+        # A busy event loop wakes sleepers up late, which delays every request the client has in flight
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(interval)
+            loop_lags.append(time.perf_counter() - start_time - interval)
+
+    async def _call(call: dict, start_time: float) -> None:
+        if speed is not None:
+            await asyncio.sleep(max(call['time'] / speed - (time.perf_counter() - start_time), 0.))
+
+        if call['method'] == 'generate':
+            await llm.agenerate(call['prompts'], call['apply_template'])
+        else:
+            await llm.acompute_target_logps(call['prompts'], call['targets'], call['apply_template'])
+
+    async def _replay() -> float:
+        monitor = asyncio.ensure_future(_monitor_loop())
+        start_time = time.perf_counter()
+
+        try:
+            if speed is None:
+                for call in calls:
+                    await _call(call, start_time)
+            else:
+                await asyncio.gather(*[_call(call, start_time) for call in calls])
+        finally:
+            monitor.cancel()
+
+        return time.perf_counter() - start_time
+
+    elapsed_time = llm.loop.run_until_complete(_replay())
+    server.stop()
+
+    stats = llm.stats()
+    num_prompts = sum(len(call['prompts']) for call in calls)
+    num_tokens = sum(
+        value for key, value in stats.items() if key.endswith(('_prompt_tokens', '_completion_tokens'))
+    )
+    loop_lags.sort()
+    print(
+        f'{len(calls)} calls, {num_prompts} prompts in {elapsed_time:.1f}s: '
+        f'{num_prompts / elapsed_time:.1f} prompts/s, {num_tokens / elapsed_time:.1f} tokens/s'
+    )
+
+    for method in ['generate', 'logps']:
+        if f'{method}_calls' in stats:
+            print(
+                f'{method} call latency: p50 {stats[f"{method}_latency_p50"]:.3f}s, '
+                f'p95 {stats[f"{method}_latency_p95"]:.3f}s, p99 {stats[f"{method}_latency_p99"]:.3f}s'
+            )
+
+    print(
+        f'concurrency limit: {stats["concurrency"]}, retries: {stats["retries"]}, '
+        f'p50 request latency: {stats["p50_latency"]:.3f}s, request throughput: {stats["throughput"]:.1f}/s'
+    )
+    print(
+        f'event loop lag: p50 {loop_lags[len(loop_lags) // 2] * 1000:.1f}ms, '
+        f'p99 {loop_lags[len(loop_lags) * 99 // 100] * 1000:.1f}ms, max {loop_lags[-1] * 1000:.1f}ms'
+        if loop_lags else 'event loop lag: not measured'
+    )
+    server_stats = server.stats()
+    print(
+        f'server: {server_stats["server_requests"]} requests, at most {server_stats["server_max_running"]} '
+        f'running, mean queue time {server_stats["server_mean_queue_time"] * 1000:.1f}ms'
+    )
+
+
+def _to_api_generate_config(generate_config: dict) -> dict:
+    """Translate a `generate_config` of a local provider (e.g. from the header of a local or mock recording)
+    to the parameters of the OpenAI-compatible API."""
+    generate_config = {key: value for key, value in generate_config.items() if value is not None}
+
+    if generate_config.pop('num_beams', 1) > 1:
+        raise ValueError('Beam search cannot be replayed through the OpenAI-compatible API')
+
+    generate_config.pop('batch_size', None)
+
+    if 'max_new_tokens' in generate_config:
+        generate_config['max_tokens'] = generate_config.pop('max_new_tokens')
+
+    if 'num_return_sequences' in generate_config:
+        generate_config['n'] = generate_config.pop('num_return_sequences')
+
+    # Greedy decoding is sampling at temperature 0 for the API
+    if not generate_config.pop('do_sample', True):
+        generate_config['temperature'] = 0.
+        generate_config.pop('top_p', None)
+        generate_config.pop('top_k', None)
+
+    return generate_config
+
+
+def serve(model: str | None = None, host: str = '127.0.0.1', port: int = 8000, **server_config) -> None:
+    """Run a stand-in server with the tokenizer of `model` until interrupted, e.g. for a run with
+    `llm.endpoint=127.0.0.1:8000`."""
+    tokenizer = AutoTokenizer.from_pretrained(model) if model is not None else None
+    server = StandInServer(host, port, tokenizer, **server_config).start()
+    print(f'Serving on {server.address}')
+
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def plackett_luce(
+    batch_size: int = 16, sample_size: int = 5, device: str = 'cpu',
+    num_samples: tuple[int, ...] = (32, 256, 1024), pool_sizes: tuple[int, ...] = (20, 100, 1000),
+    num_repeats: int = 5
+) -> None:
+    """Compare the time of a sampling step (sampling and backpropagating through the log-probabilities)
+    of `reinforce.sample` against sequential sampling, one item and one sample at a time."""
+
+    def _sample_sequential(likelihoods: torch.Tensor, num_samples: int) -> torch.Tensor:
+        logps = []
+
+        for _ in range(num_samples):
+            remaining = likelihoods
+            logp = 0.
+
+            for _ in range(sample_size):
+                probs = remaining / remaining.sum(dim=1, keepdim=True)
+                item_indices = torch.multinomial(probs, num_samples=1)
+                logp = logp + probs.gather(dim=1, index=item_indices).log().squeeze(dim=1)
+                remaining = remaining.scatter(dim=1, index=item_indices, value=0.)
+
+            logps.append(logp)
+
+        return torch.stack(logps, dim=1)
+
+    def _time(fn: Callable[[torch.Tensor], torch.Tensor], pool_size: int) -> float:
+        start_time = time.perf_counter()
+
+        for _ in range(num_repeats):
+            likelihoods = torch.rand(batch_size, pool_size, device=device, requires_grad=True)
+            fn(likelihoods).sum().backward()
+
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+        return (time.perf_counter() - start_time) / num_repeats * 1000
+
+    for pool_size in pool_sizes:
+        for num_samples_ in num_samples:
+            sequential_time = _time(
+                lambda likelihoods: _sample_sequential(likelihoods, num_samples_), pool_size
+            )
+            vectorized_time = _time(
+                lambda likelihoods: reinforce.sample(likelihoods, num_samples_, sample_size)[1], pool_size
+            )
+            print(
+                f'pool {pool_size}, {num_samples_} samples: sequential {sequential_time:.1f}ms, '
+                f'gumbel-top-k {vectorized_time:.1f}ms ({sequential_time / vectorized_time:.1f}x)'
+            )
+
+
+def unique_slates(
+    num_items: int = 20, sample_size: int = 5, num_samples: tuple[int, ...] = (8, 16, 32),
+    concentration: float = 2., num_trials: int = 200, seed: int = 0
+) -> None:
+    """Compare the gradient estimates of `reinforce.sample` and `reinforce.sample_unique` against the exact
+    gradient of the expected reward over all slates, by their mean cosine similarity and their number of LLM
+    calls (distinct slates) per example.
+
+    Rewards are a position-discounted sum of random item utilities, and log-likelihoods are normal with a
+    standard deviation of `concentration`, so that higher values give more duplicate slates.
+    """
+    torch.manual_seed(seed)
+    utilities = torch.randn(num_items)
+    discounts = 1 / torch.arange(2, sample_size + 2).float().log2()
+    logits = (torch.randn(1, num_items) * concentration).requires_grad_()
+
+    def _reward(indices: torch.Tensor) -> torch.Tensor:
+        return (utilities[indices] * discounts).sum(dim=-1)
+
+    def _estimate(sample_fn: Callable[[torch.Tensor], tuple[torch.Tensor, ...]]) -> tuple[float, float]:
+        similarities = []
+        num_calls = []
+
+        for _ in range(num_trials):
+            logits.grad = None
+            indices, logps, *weights = sample_fn(logits.exp())
+
+            if weights:
+                loss = reinforce.compute_weighted_loss(logps, _reward(indices), weights[0])
+                num_calls.append((weights[0] > 0).sum().item())
+            else:
+                loss = reinforce.compute_loss(logps, _reward(indices))
+                num_calls.append(len(set(map(tuple, indices[0].tolist()))))
+
+            loss.backward()
+            similarities.append(torch.cosine_similarity(-logits.grad, exact_grad, dim=1).item())
+
+        return sum(similarities) / num_trials, sum(num_calls) / num_trials
+
+    # The exact gradient of the expected reward, by enumerating every slate
+    all_indices = torch.tensor(list(itertools.permutations(range(num_items), sample_size))).unsqueeze(dim=0)
+    logps = reinforce._compute_logps(logits.expand(all_indices.shape[1], -1).unsqueeze(dim=0), all_indices)
+    exact_grad, = torch.autograd.grad(torch.sum(logps.exp() * _reward(all_indices)), logits)
+    del all_indices, logps
+
+    for num_samples_ in num_samples:
+        similarity, num_calls = _estimate(
+            lambda likelihoods: reinforce.sample(likelihoods, num_samples_, sample_size)
+        )
+        unique_similarity, unique_num_calls = _estimate(
+            lambda likelihoods: reinforce.sample_unique(likelihoods, num_samples_, sample_size)
+        )
+        print(
+            f'{num_samples_} samples: i.i.d. similarity {similarity:.3f} ({num_samples_} calls, '
+            f'{num_calls:.1f} distinct), unique similarity {unique_similarity:.3f} '
+            f'({unique_num_calls:.1f} calls)'
+        )
+
+
+def _load_model(model: str | None, device: str, **config_kwargs) -> PreTrainedModel:
+    if model is None:
+        torch.manual_seed(0)
+        config = LlamaConfig(**{
+            'vocab_size': 32000,
+            'hidden_size': 256,
+            'intermediate_size': 688,
+            'num_hidden_layers': 4,
+            'num_attention_heads': 4,
+            'num_key_value_heads': 2,
+            **config_kwargs
+        })
+        model = LlamaForCausalLM(config)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model, torch_dtype='auto')
+
+    # Never stop early, so that every method generates the same number of tokens
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = 0
+    return model.to(device).eval()
+
+
+def _create_prompts(model: PreTrainedModel, num_prompts: int, prompt_length: int) -> list[list[int]]:
+    generator = torch.Generator().manual_seed(0)
+    lengths = torch.randint(prompt_length // 2, prompt_length + 1, (num_prompts,), generator=generator)
+    return [
+        torch.randint(1, model.config.vocab_size, (length,), generator=generator).tolist()
+        for length in lengths.tolist()
+    ]
+
+
+def _create_texts(tokenizer: PreTrainedTokenizerBase, num_texts: int, length: int) -> list[str]:
+    generator = torch.Generator().manual_seed(0)
+    return [
+        tokenizer.decode(
+            torch.randint(0, tokenizer.vocab_size, (length,), generator=generator).tolist(),
+            skip_special_tokens=True
+        )
+        for _ in range(num_texts)
+    ]
+
+
+def _measure(fn: Callable[[], int]) -> float:
+    """Return the tokens per second of `fn`, which returns the number of tokens it generated."""
+    start_time = time.perf_counter()
+    num_tokens = fn()
+    return num_tokens / (time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -1,3 +1,3 @@
 from .dataset import load_lamp_dataset
-from .metric import create_metric, get_labels
+from .metric import LABELED_TASKS, create_metric, get_labels
 from .prompt import create_prompt_generator
@@ -6,6 +6,10 @@ import evaluate
 from .data_types import Metric
 
 
+# Tasks whose responses are one of a fixed set of labels
+LABELED_TASKS = {'LaMP-1', 'LaMP-2', 'LaMP-3'}
+
+
 def get_labels(task: str) -> list[str]:
     if task == 'LaMP-1':
         return ['[1]', '[2]']
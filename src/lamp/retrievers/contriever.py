@@ -10,7 +10,7 @@ class Contriever:
     def __init__(self) -> None:
         self.tokenizer = AutoTokenizer.from_pretrained('facebook/contriever')
         self.contriever = AutoModel.from_pretrained('facebook/contriever')
-        self.contriever.to('cuda')
+        self.contriever.to('cuda' if torch.cuda.is_available() else 'cpu')
         self.contriever.eval()
 
     @torch.no_grad()
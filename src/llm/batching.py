@@ -0,0 +1,65 @@
+import torch
+
+
+def plan_micro_batches(lengths: list[int], max_batch_tokens: int) -> list[list[int]]:
+    """Group sequence indices into micro-batches whose padded size stays within `max_batch_tokens`."""
+    order = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+    micro_batches = []
+    micro_batch = []
+
+    for index in order:
+        # Sequences are visited longest first, so the first one sets the padded length of the micro-batch
+        if micro_batch and lengths[micro_batch[0]] * (len(micro_batch) + 1) > max_batch_tokens:
+            micro_batches.append(micro_batch)
+            micro_batch = []
+
+        micro_batch.append(index)
+
+    if micro_batch:
+        micro_batches.append(micro_batch)
+
+    return micro_batches
+
+
+def plan_requests(lengths: list[int], max_request_tokens: int, max_request_prompts: int) -> list[list[int]]:
+    """Split consecutive sequence indices into requests of at most `max_request_tokens` total tokens and
+    `max_request_prompts` sequences."""
+    requests = []
+    request = []
+    request_tokens = 0
+
+    for index, length in enumerate(lengths):
+        if request and (request_tokens + length > max_request_tokens or len(request) >= max_request_prompts):
+            requests.append(request)
+            request = []
+            request_tokens = 0
+
+        request.append(index)
+        request_tokens += length
+
+    if request:
+        requests.append(request)
+
+    return requests
+
+
+def left_pad(
+    sequences: list[list[int]], pad_token_id: int, device: torch.device, prefix_length: int = 0
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Left-pad `sequences` and return input IDs, attention mask and position IDs.
+
+    With a non-zero `prefix_length`, `sequences` continue a prefix of that length held in a KV cache. The
+    attention mask then also covers the prefix, while input IDs and position IDs only cover `sequences`.
+    """
+    max_length = max(len(sequence) for sequence in sequences)
+    input_ids = torch.full((len(sequences), max_length), fill_value=pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), prefix_length + max_length), dtype=torch.long)
+    attention_mask[:, :prefix_length] = 1
+
+    for i, sequence in enumerate(sequences):
+        input_ids[i, max_length - len(sequence):] = torch.tensor(sequence, dtype=torch.long)
+        attention_mask[i, prefix_length + max_length - len(sequence):] = 1
+
+    # Positions must start from zero at the first real token, not at the first padding token
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, prefix_length:]
+    return input_ids.to(device), attention_mask.to(device), position_ids.to(device)
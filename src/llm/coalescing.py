@@ -0,0 +1,132 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Sequence
+
+
+class RequestCoalescer:
+    """Sends each distinct request to the backend once, both within a call and across concurrent calls."""
+
+    def __init__(self) -> None:
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+        # Callers awaiting each in-flight future, and the backend call resolving it
+        self.num_waiters: dict[asyncio.Future, int] = {}
+        self.calls: dict[asyncio.Future, asyncio.Task] = {}
+        self.num_requests = 0
+        self.num_duplicates = 0
+
+    async def run(self, keys: list[Hashable], fn: Callable[[list[int]], Awaitable[Sequence[Any]]]) -> (
+        list[Any]
+    ):
+        """Call `fn` on the first index of each distinct key not already in flight in a concurrent call, and
+        fan the results out to all keys.
+
+        `fn` runs in a task of its own, which a cancelled caller only cancels if no other caller awaits any of
+        its results.
+        """
+        unique_indices, inverse = self._deduplicate(keys)
+        loop = asyncio.get_running_loop()
+        futures = []
+        owned_positions = []
+
+        for position, index in enumerate(unique_indices):
+            if keys[index] in self.in_flight:
+                self.num_duplicates += 1
+            else:
+                self.in_flight[keys[index]] = loop.create_future()
+                owned_positions.append(position)
+
+            future = self.in_flight[keys[index]]
+            self.num_waiters[future] = self.num_waiters.get(future, 0) + 1
+            futures.append(future)
+
+        if owned_positions:
+            owned_keys = [keys[unique_indices[position]] for position in owned_positions]
+            owned_futures = [futures[position] for position in owned_positions]
+            call = asyncio.ensure_future(self._call(
+                fn, [unique_indices[position] for position in owned_positions], owned_keys, owned_futures
+            ))
+
+            for future in owned_futures:
+                self.calls[future] = call
+
+        try:
+            # Shield the shared futures, so that cancelling this caller leaves them to the others
+            unique_results = [await asyncio.shield(future) for future in futures]
+        finally:
+            self._release(futures)
+
+        return [unique_results[position] for position in inverse]
+
+    async def _call(
+        self, fn: Callable[[list[int]], Awaitable[Sequence[Any]]], indices: list[int], keys: list[Hashable],
+        futures: list[asyncio.Future]
+    ) -> None:
+        try:
+            results = await fn(indices)
+
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+        except BaseException as err:
+            for future in futures:
+                if future.done():
+                    continue
+
+                if isinstance(err, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(err)
+                    # Callers re-raise it, so don't report it as never retrieved
+                    future.exception()
+
+            if isinstance(err, asyncio.CancelledError):
+                raise
+        finally:
+            for key, future in zip(keys, futures):
+                if self.in_flight.get(key) is future:
+                    del self.in_flight[key]
+
+                self.calls.pop(future, None)
+
+    def _release(self, futures: list[asyncio.Future]) -> None:
+        """Stop waiting for `futures`, and cancel the backend calls nobody waits for anymore."""
+        calls = set()
+
+        for future in futures:
+            self.num_waiters[future] -= 1
+
+            if self.num_waiters[future] == 0:
+                del self.num_waiters[future]
+
+            if future in self.calls:
+                calls.add(self.calls[future])
+
+        for call in calls:
+            call_futures = [future for future, future_call in self.calls.items() if future_call is call]
+
+            if not call.done() and not any(future in self.num_waiters for future in call_futures):
+                # Let later callers send these requests again rather than join a cancelled call
+                for key, future in list(self.in_flight.items()):
+                    if future in call_futures:
+                        del self.in_flight[key]
+
+                call.cancel()
+
+    def stats(self) -> dict[str, int]:
+        return {'requests': self.num_requests, 'duplicate_requests': self.num_duplicates}
+
+    def _deduplicate(self, keys: list[Hashable]) -> tuple[list[int], list[int]]:
+        """Return the first index of each distinct key, and for every key the position of its first index."""
+        positions = {}
+        unique_indices = []
+        inverse = []
+
+        for index, key in enumerate(keys):
+            if key not in positions:
+                positions[key] = len(unique_indices)
+                unique_indices.append(index)
+
+            inverse.append(positions[key])
+
+        self.num_requests += len(keys)
+        self.num_duplicates += len(keys) - len(unique_indices)
+        return unique_indices, inverse
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class CompletionCache:
+    """On-disk LRU cache of LLM completions keyed by a hash of everything that determines them."""
+
+    def __init__(self, path: str, max_size_mb: float = 1024.) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Shared between the event loop and executor threads, which take turns on it under `lock`
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS completions '
+            '(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS last_access_index ON completions (last_access)')
+        self.connection.commit()
+
+        self.max_size = int(max_size_mb * 2 ** 20)
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def create_key(**fields) -> str:
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, keys: list[str]) -> list[str | list[str] | None]:
+        """Return the cached completion of each key, or None if it is missing."""
+        with self.lock:
+            return self._get(keys)
+
+    def put(self, items: dict[str, str | list[str]]) -> None:
+        with self.lock:
+            self._put(items)
+
+    def stats(self) -> dict[str, int]:
+        return {'cache_hits': self.hits, 'cache_misses': self.misses, 'cache_size': self.size}
+
+    def _get(self, keys: list[str]) -> list[str | list[str] | None]:
+        responses = []
+        hit_keys = []
+
+        for key in keys:
+            row = self.connection.execute('SELECT response FROM completions WHERE key = ?', (key,)).fetchone()
+            responses.append(json.loads(row[0]) if row is not None else None)
+
+            if row is not None:
+                hit_keys.append(key)
+
+        self.hits += len(hit_keys)
+        self.misses += len(keys) - len(hit_keys)
+
+        # Update access times of all hits in one transaction rather than one per hit
+        if hit_keys:
+            access_time = time.time()
+            self.connection.executemany(
+                'UPDATE completions SET last_access = ? WHERE key = ?', [(access_time, key) for key in hit_keys]
+            )
+            self.connection.commit()
+
+        return responses
+
+    def _put(self, items: dict[str, str | list[str]]) -> None:
+        for key, response in items.items():
+            serialized = json.dumps(response)
+            old_row = self.connection.execute('SELECT size FROM completions WHERE key = ?', (key,)).fetchone()
+            self.size += len(serialized) - (old_row[0] if old_row is not None else 0)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)',
+                (key, serialized, len(serialized), time.time())
+            )
+
+        self._evict()
+        self.connection.commit()
+
+    def _evict(self) -> None:
+        """Drop least recently used completions until the cache fits in `max_size`."""
+        if self.size <= self.max_size:
+            return
+
+        evicted_keys = []
+
+        for key, size in self.connection.execute('SELECT key, size FROM completions ORDER BY last_access'):
+            if self.size <= self.max_size:
+                break
+
+            evicted_keys.append((key,))
+            self.size -= size
+
+        self.connection.executemany('DELETE FROM completions WHERE key = ?', evicted_keys)
@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import time
+from collections import defaultdict, deque
+from typing import AsyncIterator, Iterable
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limiter for API requests.
+
+    The window grows by one per success until the first back-off (slow start), then by one per window of
+    successes. It is halved on overload errors or when p95 latency exceeds `latency_tolerance` times the
+    lowest p50 latency observed so far, at most once per p50 latency. Latencies are tracked per request kind,
+    since e.g. generation and scoring requests take very different times.
+    """
+
+    def __init__(
+        self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 256,
+        latency_tolerance: float = 3., backoff: float = 0.5, window_size: int = 100
+    ) -> None:
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+
+        self.in_flight = 0
+        self.slow_start = True
+        self.condition = asyncio.Condition()
+        self.window_size = window_size
+        self.latencies = defaultdict(lambda: deque(maxlen=window_size))
+        self.errors = deque(maxlen=window_size)
+        self.finish_times = deque(maxlen=window_size)
+        self.base_latencies = {}
+        self.last_backoff_time = 0.
+
+    @contextlib.asynccontextmanager
+    async def slot(self, kind: str = 'request') -> AsyncIterator[None]:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        start_time = time.perf_counter()
+        overloaded = None
+
+        try:
+            yield
+            overloaded = False
+        except (APIConnectionError, InternalServerError, RateLimitError):
+            overloaded = True
+            raise
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+
+                # Requests failing for other reasons (e.g. bad inputs, cancellation) say nothing about load
+                if overloaded is not None:
+                    self._update(kind, time.perf_counter() - start_time, overloaded)
+
+                self.condition.notify_all()
+
+    def stats(self) -> dict[str, float]:
+        p50_latency, p95_latency = self._latency_percentiles(
+            [latency for latencies in self.latencies.values() for latency in latencies]
+        )
+        elapsed_time = self.finish_times[-1] - self.finish_times[0] if len(self.finish_times) > 1 else 0.
+        return {
+            'concurrency': int(self.limit),
+            'in_flight': self.in_flight,
+            'p50_latency': p50_latency,
+            'p95_latency': p95_latency,
+            'error_rate': sum(self.errors) / len(self.errors) if self.errors else 0.,
+            'throughput': (len(self.finish_times) - 1) / elapsed_time if elapsed_time > 0 else 0.
+        }
+
+    def _update(self, kind: str, latency: float, overloaded: bool) -> None:
+        now = time.perf_counter()
+        self.errors.append(overloaded)
+        latencies = self.latencies[kind]
+
+        if not overloaded:
+            latencies.append(latency)
+            self.finish_times.append(now)
+
+        p50_latency, p95_latency = self._latency_percentiles(latencies)
+
+        latency_spike = False
+
+        # Only judge latency on a reasonably full window, e.g. not right after a back-off cleared it
+        if len(latencies) >= self.window_size // 2:
+            # Let the baseline drift up slowly so that a lasting change in server load is eventually accepted
+            base_latency = min(self.base_latencies.get(kind, p50_latency) * 1.001, p50_latency)
+            self.base_latencies[kind] = base_latency
+            latency_spike = p95_latency > self.latency_tolerance * base_latency
+
+        if overloaded or latency_spike:
+            # Back off at most once per round trip, since in-flight requests still reflect the old window
+            if now - self.last_backoff_time > p50_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_backoff_time = now
+                self.slow_start = False
+
+                # Latencies of every kind so far reflect the old window
+                for kind_latencies in self.latencies.values():
+                    kind_latencies.clear()
+        elif self.slow_start:
+            self.limit = min(self.max_limit, self.limit + 1)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @staticmethod
+    def _latency_percentiles(latencies: Iterable[float]) -> tuple[float, float]:
+        latencies = sorted(latencies)
+
+        if not latencies:
+            return 0., 0.
+
+        return latencies[len(latencies) // 2], latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]
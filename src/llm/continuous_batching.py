@@ -0,0 +1,200 @@
+from collections import deque
+from typing import Callable
+
+import torch
+from transformers import PreTrainedModel
+from transformers.cache_utils import DynamicCache
+
+from .batching import left_pad
+from .prefix_cache import PrefixCache
+from .sampling import create_generation_config, create_warpers, get_stop_token_ids, sample_tokens
+
+
+KeyValues = tuple[tuple[torch.Tensor, torch.Tensor], ...]
+
+
+class ContinuousBatchingEngine:
+    """Generates with continuous batching on a Hugging Face causal LM.
+
+    Each running sequence occupies one of `max_batch_size` slots, i.e. one row of a shared KV cache. Rows are
+    right-aligned, so that every decode step feeds one token per row. A finished sequence frees its slot at
+    once, and waiting prompts are prefilled and merged into the batch as soon as slots are free, instead of
+    waiting for the longest sequence of a fixed batch.
+    """
+
+    def __init__(self, model: PreTrainedModel, pad_token_id: int, max_batch_size: int = 16) -> None:
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+
+    @torch.no_grad()
+    def generate(
+        self, prompts_ids: list[list[int]], stop_token_ids: list[int], generate_config: dict,
+        prefix_cache: PrefixCache | None = None, callback: Callable[[int], None] | None = None
+    ) -> list[list[list[int]]]:
+        """Generate `num_return_sequences` completions per prompt and return their token IDs without stop
+        tokens. `callback` is called with the index of each prompt whose completions are all finished."""
+        config = create_generation_config(self.model, generate_config)
+
+        if config.num_beams > 1:
+            raise ValueError('Continuous batching does not support beam search')
+
+        num_return_sequences = config.num_return_sequences
+
+        if num_return_sequences > self.max_batch_size:
+            raise ValueError(f'num_return_sequences must be at most max_batch_size ({self.max_batch_size})')
+
+        warpers = create_warpers(config)
+        stop_token_ids = torch.tensor(get_stop_token_ids(config, stop_token_ids), device=self.model.device)
+
+        waiting = deque(range(len(prompts_ids)))
+        completions_ids = [[[] for _ in range(num_return_sequences)] for _ in prompts_ids]
+        num_unfinished = [num_return_sequences] * len(prompts_ids)
+
+        # State of the running rows: the cache holds every token so far but the next input token
+        key_values = None
+        attention_mask = None
+        next_tokens = None
+        rows = []
+        max_new_tokens = []
+
+        while waiting or rows:
+            num_free_slots = (self.max_batch_size - len(rows)) // num_return_sequences
+            # Tokens of the running rows were already recorded, unless they were just decoded
+            first_new_row = len(rows)
+
+            if waiting and num_free_slots > 0:
+                admitted = [waiting.popleft() for _ in range(min(num_free_slots, len(waiting)))]
+                new_key_values, new_attention_mask, new_logits = self._prefill(
+                    [prompts_ids[index] for index in admitted], num_return_sequences, prefix_cache
+                )
+                new_tokens = sample_tokens(new_logits, config.do_sample, warpers)
+
+                key_values, attention_mask = _merge(
+                    key_values, attention_mask, new_key_values, new_attention_mask
+                )
+                next_tokens = new_tokens if next_tokens is None else torch.cat([next_tokens, new_tokens])
+                rows += [(index, i) for index in admitted for i in range(num_return_sequences)]
+                max_new_tokens += [
+                    config.max_new_tokens or config.max_length - len(prompts_ids[index])
+                    for index in admitted for _ in range(num_return_sequences)
+                ]
+            else:
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1)
+                outputs = self.model(
+                    input_ids=next_tokens.unsqueeze(dim=1),
+                    attention_mask=attention_mask,
+                    position_ids=attention_mask.sum(dim=1, keepdim=True) - 1,
+                    past_key_values=DynamicCache.from_legacy_cache(key_values),
+                    use_cache=True
+                )
+                key_values = outputs.past_key_values.to_legacy_cache()
+                next_tokens = sample_tokens(outputs.logits[:, -1, :], config.do_sample, warpers)
+                first_new_row = 0
+
+            # Record the sampled tokens and free the slots of finished sequences
+            tokens = next_tokens.tolist()
+            stopped = torch.isin(next_tokens[first_new_row:], stop_token_ids).tolist()
+            finished = [False] * first_new_row + stopped
+
+            for row in range(first_new_row, len(rows)):
+                index, i = rows[row]
+
+                if not finished[row]:
+                    completions_ids[index][i].append(tokens[row])
+                    finished[row] = len(completions_ids[index][i]) >= max_new_tokens[row]
+
+                if finished[row]:
+                    num_unfinished[index] -= 1
+
+                    if num_unfinished[index] == 0 and callback is not None:
+                        callback(index)
+
+            if any(finished):
+                kept_rows = [row for row in range(len(rows)) if not finished[row]]
+                rows = [rows[row] for row in kept_rows]
+                max_new_tokens = [max_new_tokens[row] for row in kept_rows]
+
+                if rows:
+                    kept_rows = torch.tensor(kept_rows, device=self.model.device)
+                    key_values, attention_mask = _select_rows(key_values, attention_mask, kept_rows)
+                    next_tokens = next_tokens[kept_rows]
+                else:
+                    key_values = attention_mask = next_tokens = None
+
+        return completions_ids
+
+    def _prefill(
+        self, prompts_ids: list[list[int]], num_return_sequences: int, prefix_cache: PrefixCache | None
+    ) -> tuple[KeyValues, torch.Tensor, torch.Tensor]:
+        if prefix_cache is not None and all(prefix_cache.matches(prompt_ids) for prompt_ids in prompts_ids):
+            prefix_length = len(prefix_cache)
+            past_key_values = prefix_cache.expand(len(prompts_ids))
+        else:
+            prefix_length = 0
+            past_key_values = None
+
+        # With a prefix, padding sits between the prefix and the suffix, which the attention mask accounts for
+        input_ids, attention_mask, position_ids = left_pad(
+            [prompt_ids[prefix_length:] for prompt_ids in prompts_ids],
+            self.pad_token_id, self.model.device, prefix_length
+        )
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1
+        )
+
+        # Returned sequences of a prompt share its prefill and only diverge from their first sampled token
+        key_values = tuple(
+            (
+                keys.repeat_interleave(num_return_sequences, dim=0),
+                values.repeat_interleave(num_return_sequences, dim=0)
+            )
+            for keys, values in outputs.past_key_values.to_legacy_cache()
+        )
+        return (
+            key_values,
+            attention_mask.repeat_interleave(num_return_sequences, dim=0),
+            outputs.logits[:, -1, :].repeat_interleave(num_return_sequences, dim=0)
+        )
+
+
+def _merge(
+    key_values: KeyValues | None, attention_mask: torch.Tensor | None,
+    new_key_values: KeyValues, new_attention_mask: torch.Tensor
+) -> tuple[KeyValues, torch.Tensor]:
+    """Stack the rows of two right-aligned caches, left-padding the shorter one."""
+    if key_values is None:
+        return new_key_values, new_attention_mask
+
+    length = max(attention_mask.shape[1], new_attention_mask.shape[1])
+
+    def _pad(tensor: torch.Tensor, dim: int) -> torch.Tensor:
+        padding = list(tensor.shape)
+        padding[dim] = length - tensor.shape[dim]
+        return torch.cat([tensor.new_zeros(padding), tensor], dim=dim)
+
+    merged_key_values = tuple(
+        (
+            torch.cat([_pad(keys, dim=2), _pad(new_keys, dim=2)]),
+            torch.cat([_pad(values, dim=2), _pad(new_values, dim=2)])
+        )
+        for (keys, values), (new_keys, new_values) in zip(key_values, new_key_values)
+    )
+    return merged_key_values, torch.cat([_pad(attention_mask, dim=1), _pad(new_attention_mask, dim=1)])
+
+
+def _select_rows(key_values: KeyValues, attention_mask: torch.Tensor, rows: torch.Tensor) -> (
+    tuple[KeyValues, torch.Tensor]
+):
+    """Keep `rows` of the cache and drop the leading columns that are padding in all of them."""
+    attention_mask = attention_mask[rows]
+    start = attention_mask.any(dim=0).nonzero()[0].item()
+    key_values = tuple(
+        (keys[rows, :, start:], values[rows, :, start:]) for keys, values in key_values
+    )
+    return key_values, attention_mask[:, start:]
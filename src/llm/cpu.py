@@ -0,0 +1,40 @@
+import logging
+
+import torch
+from transformers import PreTrainedModel
+
+
+logger = logging.getLogger(__name__)
+
+
+def configure_cpu(cpu_config: dict) -> str:
+    """Set the thread count of `cpu_config` and return the dtype to load the model in. Quantization takes
+    precedence over `dtype`, which defaults to bfloat16."""
+    if cpu_config.get('num_threads') is not None:
+        torch.set_num_threads(cpu_config['num_threads'])
+
+    quantization = cpu_config.get('quantization')
+
+    if quantization == 'int8':
+        # Dynamically quantized linear layers take float32 activations
+        return 'float32'
+    elif quantization is not None:
+        raise ValueError(f'Invalid CPU quantization: {quantization}')
+
+    dtype = cpu_config.get('dtype') or 'bfloat16'
+
+    # Without AVX-512 BF16 or AMX, bfloat16 matmuls are emulated and slower than float32 ones
+    if dtype == 'bfloat16' and not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        logger.warning('This CPU has no native bfloat16 support, loading the model in float32 instead')
+        return 'float32'
+
+    return dtype
+
+
+def quantize_int8(model: PreTrainedModel) -> PreTrainedModel:
+    """Quantize the linear layers of the decoder to int8 weights, with activations quantized on the fly. The
+    LM head stays in float32, since log-probs are computed from its weights directly."""
+    torch.ao.quantization.quantize_dynamic(
+        model.get_decoder(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    return model
@@ -0,0 +1,237 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import struct
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelDaemon:
+    """Serves one local `LLM` to many client processes over a Unix socket.
+
+    Requests from all clients are queued and gathered into batches of up to `max_batch_size` prompts, waiting
+    at most `max_wait` seconds for more requests after the first one. Requests of a batch are grouped by
+    method, task and decoding parameters, and each group runs as a single call of the model, so that
+    prompts of different processes share forward passes.
+    """
+
+    def __init__(
+        self, socket_path: str, max_batch_size: int = 64, max_wait: float = 0.01, **llm_kwargs
+    ) -> None:
+        # Imported here, since `LLM` imports the client side of this module
+        from .llm import LLM
+
+        self.socket_path = socket_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # Clients score labels themselves, through `compute_target_logps`. Batches of the model hold the
+        # prompts gathered from all clients, rather than the batch size of a client's config.
+        self.llm = LLM(**{
+            **llm_kwargs,
+            'generate_config': {**llm_kwargs['generate_config'], 'batch_size': max_batch_size},
+            'label_scoring': False
+        })
+        self.requests = None
+
+    def serve(self) -> None:
+        asyncio.run(self._serve())
+
+    async def _serve(self) -> None:
+        self.requests = asyncio.Queue()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        logger.info(f'Serving {self.llm.model} on {self.socket_path}')
+
+        async with server:
+            await self._run_batches()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        lock = asyncio.Lock()
+        responses = set()
+
+        async def _respond(request: dict, future: asyncio.Future) -> None:
+            try:
+                response = {'id': request['id'], 'result': await future}
+            except Exception as err:
+                response = {'id': request['id'], 'error': f'{type(err).__name__}: {err}'}
+
+            try:
+                async with lock:
+                    await _write_message(writer, response)
+            except ConnectionError:
+                # The client is gone, and so is whoever waited for the response
+                pass
+
+        try:
+            while (request := await _read_message(reader)) is not None:
+                future = asyncio.get_running_loop().create_future()
+                await self.requests.put((request, future))
+                response = asyncio.ensure_future(_respond(request, future))
+                # Hold a reference so that the pending response is not garbage collected
+                responses.add(response)
+                response.add_done_callback(responses.discard)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _run_batches(self) -> None:
+        while True:
+            batch = [await self.requests.get()]
+            num_prompts = len(batch[0][0]['prompts'])
+            deadline = asyncio.get_running_loop().time() + self.max_wait
+
+            while num_prompts < self.max_batch_size:
+                try:
+                    timeout = deadline - asyncio.get_running_loop().time()
+                    batch.append(await asyncio.wait_for(self.requests.get(), max(timeout, 0.)))
+                    num_prompts += len(batch[-1][0]['prompts'])
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+
+            for request, future in batch:
+                # The daemon sets the batch size itself, so clients' batch sizes shouldn't split groups
+                generate_config = {
+                    key: value for key, value in request['generate_config'].items() if key != 'batch_size'
+                }
+                key = (
+                    request['method'], request['task'], request['apply_template'],
+                    json.dumps(generate_config, sort_keys=True)
+                )
+                groups.setdefault(key, []).append((request, future))
+
+            for group in groups.values():
+                await self._run_group(group)
+
+    async def _run_group(self, group: list[tuple[dict, asyncio.Future]]) -> None:
+        request = group[0][0]
+        prompts = [prompt for request, _ in group for prompt in request['prompts']]
+
+        try:
+            # Run the model in a worker thread so that clients keep being served
+            results = await asyncio.to_thread(self._call, request, prompts, [
+                target for request, _ in group for target in request.get('targets', [])
+            ])
+        except Exception as err:
+            logger.error(f'Failed to serve {request["method"]}: {err}', exc_info=True)
+
+            for _, future in group:
+                future.set_exception(err)
+
+            return
+
+        start = 0
+
+        for request, future in group:
+            future.set_result(results[start:start + len(request['prompts'])])
+            start += len(request['prompts'])
+
+    def _call(self, request: dict, prompts: list[str], targets: list[str]) -> list:
+        # Requests are grouped by task and decoding parameters, so the LLM takes those of the group
+        self.llm.task = request['task']
+        self.llm.generate_config = {**request['generate_config'], 'batch_size': self.max_batch_size}
+
+        if request['method'] == 'generate':
+            return self.llm.generate(prompts, request['apply_template'])
+        elif request['method'] == 'compute_target_logps':
+            return self.llm.compute_target_logps(prompts, targets, request['apply_template']).tolist()
+        else:
+            raise ValueError(f'Invalid method: {request["method"]}')
+
+
+class DaemonClient(asyncio.Protocol):
+    """Client of a `ModelDaemon`, which multiplexes concurrent requests over one connection."""
+
+    def __init__(self, socket_path: str) -> None:
+        self.socket_path = socket_path
+        self.request_ids = itertools.count()
+        self.pending: dict[int, asyncio.Future] = {}
+        self.transport = None
+        self.buffer = b''
+        self.connecting = None
+
+    async def request(self, method: str, task: str, generate_config: dict, apply_template: bool, **inputs) -> (
+        list[Any]
+    ):
+        await self._connect()
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        content = json.dumps({
+            'id': request_id,
+            'method': method,
+            'task': task,
+            'generate_config': generate_config,
+            'apply_template': apply_template,
+            **inputs
+        }).encode()
+
+        try:
+            self.transport.write(struct.pack('>I', len(content)) + content)
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+
+        # Resolve every complete length-prefixed response in the buffer
+        while len(self.buffer) >= 4 and len(self.buffer) >= 4 + struct.unpack('>I', self.buffer[:4])[0]:
+            length = struct.unpack('>I', self.buffer[:4])[0]
+            response = json.loads(self.buffer[4:4 + length])
+            self.buffer = self.buffer[4 + length:]
+            future = self.pending.get(response['id'])
+
+            if future is None or future.done():
+                continue
+
+            if 'error' in response:
+                future.set_exception(RuntimeError(f'Daemon error: {response["error"]}'))
+            else:
+                future.set_result(response['result'])
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'Lost the connection to {self.socket_path}'))
+
+        # Reconnect on the next request
+        self.transport = self.connecting = None
+        self.buffer = b''
+
+    async def _connect(self) -> None:
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(
+                asyncio.get_running_loop().create_unix_connection(lambda: self, self.socket_path)
+            )
+
+        try:
+            self.transport, _ = await self.connecting
+        except OSError:
+            self.connecting = None
+            raise
+
+
+async def _read_message(reader: asyncio.StreamReader) -> dict | None:
+    """Read a length-prefixed JSON message, or return None at the end of the stream."""
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError:
+        return None
+
+    return json.loads(await reader.readexactly(struct.unpack('>I', header)[0]))
+
+
+async def _write_message(writer: asyncio.StreamWriter, message: dict) -> None:
+    content = json.dumps(message).encode()
+    writer.write(struct.pack('>I', len(content)) + content)
+    await writer.drain()
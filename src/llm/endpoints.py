@@ -0,0 +1,237 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import defaultdict, deque
+from typing import AsyncContextManager, Awaitable, Callable, TypeVar
+
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAIError
+
+from .concurrency import AdaptiveLimiter
+
+
+logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+
+class ReplicaEjectedError(OpenAIError):
+    """Raised for a request left unfinished on a replica that got ejected, so that it is retried elsewhere."""
+
+    body = None
+
+
+class _Replica:
+
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.client = AsyncOpenAI(api_key='EMPTY', base_url=f'http://{endpoint}/v1')
+        self.outstanding = 0
+        self.failures = 0
+        self.latency = None
+        self.ejected = asyncio.Event()
+        self.ejected_until = 0.
+        self.last_check_time = time.monotonic()
+        self.checking = False
+
+
+class EndpointPool:
+    """Routes requests across server replicas.
+
+    Requests go to the healthy replica with the fewest outstanding requests, weighted by its recent latency.
+    A replica is ejected after `max_failures` consecutive connection or server errors, and its unfinished
+    requests fail with `ReplicaEjectedError`. Replicas are probed every `health_check_interval` seconds, and
+    ejected ones are readmitted once a probe succeeds after `ejection_time` seconds.
+
+    If `hedge_percentile` is set, a request still unanswered at that percentile of recent latencies of its
+    kind (e.g. `generate`, `logps`) is duplicated on another replica (or the same one if it is the only
+    healthy one). The first answer wins and the other request is cancelled. At most `max_hedge_fraction` of
+    requests are hedged. Every request, including hedges, takes a slot of `limiter` if given.
+    """
+
+    def __init__(
+        self, endpoints: list[str], limiter: AdaptiveLimiter | None = None,
+        max_failures: int = 3, ejection_time: float = 30., health_check_interval: float = 10.,
+        hedge_percentile: float | None = None, max_hedge_fraction: float = 0.05, window_size: int = 100
+    ) -> None:
+        self.replicas = [_Replica(endpoint) for endpoint in endpoints]
+        self.limiter = limiter
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.health_check_interval = health_check_interval
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_fraction = max_hedge_fraction
+        self.latencies = defaultdict(lambda: deque(maxlen=window_size))
+        self.num_ejections = 0
+        self.num_calls = 0
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.health_checks = set()
+
+    async def call(self, fn: Callable[[AsyncOpenAI], Awaitable[T]], kind: str = 'request') -> T:
+        """Run `fn` with the client of the chosen replica, hedging it on another replica if it is slow for a
+        request of its `kind`."""
+        self.num_calls += 1
+
+        async with self._slot(kind):
+            return await self._call(fn, kind)
+
+    async def _call(self, fn: Callable[[AsyncOpenAI], Awaitable[T]], kind: str) -> T:
+        replica = self._choose()
+        attempts = [asyncio.ensure_future(self._attempt(replica, fn, kind))]
+
+        try:
+            hedge_delay = self._hedge_delay(kind)
+
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+
+                if not done and self.num_hedges < self.max_hedge_fraction * self.num_calls:
+                    self.num_hedges += 1
+                    attempts.append(asyncio.ensure_future(self._hedge(replica, fn, kind)))
+
+            # Take the first successful answer, and only fail once every attempt has
+            error = None
+            pending = set(attempts)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not attempts[0]:
+                            self.num_hedge_wins += 1
+
+                        return attempt.result()
+
+                    error = error or attempt.exception()
+
+            raise error
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                elif not attempt.cancelled():
+                    # Don't report the loser's error as never retrieved
+                    attempt.exception()
+
+    async def _hedge(self, replica: _Replica, fn: Callable[[AsyncOpenAI], Awaitable[T]], kind: str) -> T:
+        # A hedge is one more request in flight, so it waits for a slot of its own
+        async with self._slot(kind):
+            return await self._attempt(self._choose(exclude=replica), fn, kind)
+
+    def _slot(self, kind: str) -> AsyncContextManager[None]:
+        return self.limiter.slot(kind) if self.limiter is not None else contextlib.nullcontext()
+
+    async def _attempt(self, replica: _Replica, fn: Callable[[AsyncOpenAI], Awaitable[T]], kind: str) -> T:
+        replica.outstanding += 1
+        start_time = time.perf_counter()
+        request = asyncio.ensure_future(fn(replica.client))
+        # A replica chosen while ejected, when failing open, is given the request rather than raced against
+        # its already set event
+        ejection = None if replica.ejected.is_set() else asyncio.ensure_future(replica.ejected.wait())
+
+        try:
+            await asyncio.wait(
+                [request] if ejection is None else [request, ejection], return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if not request.done():
+                request.cancel()
+                raise ReplicaEjectedError(f'Replica {replica.endpoint} was ejected')
+
+            output = request.result()
+        except (APIConnectionError, InternalServerError):
+            self._record_failure(replica)
+            raise
+        finally:
+            replica.outstanding -= 1
+
+            if ejection is not None:
+                ejection.cancel()
+
+            if not request.done():
+                request.cancel()
+
+        replica.failures = 0
+        latency = time.perf_counter() - start_time
+        replica.latency = latency if replica.latency is None else 0.8 * replica.latency + 0.2 * latency
+        self.latencies[kind].append(latency)
+        return output
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'healthy_replicas': sum(not replica.ejected.is_set() for replica in self.replicas),
+            'replica_ejections': self.num_ejections,
+            'hedged_requests': self.num_hedges,
+            'hedge_wins': self.num_hedge_wins
+        }
+
+    def _hedge_delay(self, kind: str) -> float | None:
+        latencies = self.latencies[kind]
+
+        # Percentiles of a nearly empty window are too noisy to act on
+        if self.hedge_percentile is None or len(latencies) < latencies.maxlen // 2:
+            return None
+
+        latencies = sorted(latencies)
+        return latencies[min(int(self.hedge_percentile * len(latencies)), len(latencies) - 1)]
+
+    def _choose(self, exclude: _Replica | None = None) -> _Replica:
+        self._schedule_health_checks()
+        healthy = [replica for replica in self.replicas if not replica.ejected.is_set()]
+
+        if exclude is not None and len(healthy) > 1:
+            healthy = [replica for replica in healthy if replica is not exclude]
+
+        if not healthy:
+            # Fail open to the replica expected back first rather than refusing to send anything
+            return min(self.replicas, key=lambda replica: replica.ejected_until)
+
+        # Replicas without a latency estimate yet are assumed as fast as the fastest known one
+        known_latencies = [replica.latency for replica in healthy if replica.latency is not None]
+        default_latency = min(known_latencies) if known_latencies else 1.
+        return min(healthy, key=lambda replica: (
+            (replica.outstanding + 1) * (replica.latency if replica.latency is not None else default_latency)
+        ))
+
+    def _record_failure(self, replica: _Replica) -> None:
+        replica.failures += 1
+
+        if replica.failures >= self.max_failures and not replica.ejected.is_set():
+            logger.warning(f'Ejecting replica {replica.endpoint} after {replica.failures} consecutive failures')
+            replica.ejected.set()
+            replica.ejected_until = time.monotonic() + self.ejection_time
+            self.num_ejections += 1
+
+    def _schedule_health_checks(self) -> None:
+        now = time.monotonic()
+
+        for replica in self.replicas:
+            if (
+                not replica.checking
+                and now - replica.last_check_time > self.health_check_interval
+                and now > replica.ejected_until
+            ):
+                replica.checking = True
+                health_check = asyncio.ensure_future(self._check_health(replica))
+                # Hold a reference so that the pending check is not garbage collected
+                self.health_checks.add(health_check)
+                health_check.add_done_callback(self.health_checks.discard)
+
+    async def _check_health(self, replica: _Replica) -> None:
+        try:
+            await asyncio.wait_for(replica.client.models.list(), timeout=self.health_check_interval)
+        except (OpenAIError, asyncio.TimeoutError):
+            if replica.ejected.is_set():
+                replica.ejected_until = time.monotonic() + self.ejection_time
+            else:
+                self._record_failure(replica)
+        else:
+            if replica.ejected.is_set():
+                logger.info(f'Readmitting replica {replica.endpoint}')
+                replica.ejected = asyncio.Event()
+
+            replica.failures = 0
+        finally:
+            replica.last_check_time = time.monotonic()
+            replica.checking = False
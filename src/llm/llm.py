@@ -1,54 +1,191 @@
 import asyncio
+import contextlib
 import logging
-from typing import TypeAlias
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, TypeAlias, TypeVar
 
 import torch
 from torch.utils.data import Dataset
-from transformers import AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig, LogitsProcessorList, pipeline
 from transformers.pipelines.text_generation import Chat
 
-from openai import AsyncOpenAI, OpenAIError
+from openai import OpenAIError
 from tqdm import tqdm
 
+from .batching import left_pad, plan_micro_batches, plan_requests
+from .coalescing import RequestCoalescer
+from .completion_cache import CompletionCache
+from .concurrency import AdaptiveLimiter
+from .continuous_batching import ContinuousBatchingEngine
+from .cpu import configure_cpu, quantize_int8
+from .daemon import DaemonClient
+from .endpoints import EndpointPool, ReplicaEjectedError
+from .logps import compute_token_logps
+from .mock import MockBackend
+from .prefix_cache import PrefixCache, find_shared_prefix
+from .recording import CallRecorder
+from .sampling import create_generation_config, create_warpers
+from .scheduling import PrefixScheduler
+from .speculative_decoding import SpeculativeDecoder
+from .static_decoding import StaticDecoder
+from .streaming import stream_chunks
 from .system_prompts import SYSTEM_PROMPTS
+from .telemetry import CallMetrics
+from .worker_pool import WorkerPool
 
 
 logger = logging.getLogger(__name__)
 Message: TypeAlias = list[dict[str, str]]
+T = TypeVar('T')
 
 
 class LLM:
 
     def __init__(
         self, task: str, model: str,
-        provider: str, endpoint: str | None,
-        generate_config: dict
+        provider: str, endpoint: str | list[str] | None,
+        generate_config: dict, logp_config: dict | None = None,
+        prefix_cache: bool = False, completion_cache: dict | None = None,
+        concurrency_config: dict | None = None, send_token_ids: bool = False,
+        coalesce_stochastic: bool = False, prefix_scheduling: bool = False,
+        endpoint_config: dict | None = None, context_window: int | None = None,
+        static_cache: dict | None = None, draft_model: str | None = None, num_draft_tokens: int = 4,
+        label_scoring: bool = False, labels: list[str] | None = None,
+        device: str = 'cuda', worker_config: dict | None = None, cpu_config: dict | None = None,
+        record_path: str | None = None, token_telemetry: bool = False, mock_config: dict | None = None
     ) -> None:
         self.task = task
         self.model = model
         self.provider = provider
         self.endpoint = endpoint
         self.generate_config = generate_config
+        self.logp_config = logp_config or {}
+        self.send_token_ids = send_token_ids
+        self.coalesce_stochastic = coalesce_stochastic
+        self.coalescer = RequestCoalescer()
+        self.metrics = CallMetrics()
+        # Token counts re-tokenize every prompt and response, so they are only taken on request or for recording
+        self.token_telemetry = token_telemetry or record_path is not None
+        self.recorder = None
+        self.scheduler = PrefixScheduler() if prefix_scheduling else None
+        self.prefix_cache = None
+        self.static_decoder = None
+        self.speculative_decoder = None
+        self.limiter = None
+        self.endpoints = None
+        self.pool = None
+        self.completion_cache = None
+        self.cache_stochastic = False
+        self.num_truncated_prompts = 0
+        self.num_over_length_prompts = 0
+        # Classification and rating tasks can score their labels instead of generating free text
+        self.labels = labels
+        self.label_scoring = label_scoring and labels is not None
 
-        if self.provider == 'local':
+        # Synchronous methods drive the asynchronous ones on this loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        if completion_cache is not None:
+            self.completion_cache = CompletionCache(
+                completion_cache['path'],
+                completion_cache.get('max_size_mb', 1024.)
+            )
+            self.cache_stochastic = completion_cache.get('stochastic', False)
+
+        if record_path is not None:
+            self.recorder = CallRecorder(record_path, task, model, provider, generate_config)
+
+        if self.provider in ('local', 'local_cb'):
+            # All model calls run on one thread, so that concurrent calls neither run the model at the same
+            # time nor share decoder state, and compiled CUDA graphs (which are per thread) are reused
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llm')
+            cpu_config = cpu_config or {}
             self.pipeline = pipeline(
                 task='text-generation',
                 model=self.model,
-                device_map='cuda',
-                torch_dtype='bfloat16'
+                device_map=device,
+                torch_dtype=configure_cpu(cpu_config) if device == 'cpu' else 'bfloat16'
             )
+
+            if device == 'cpu' and cpu_config.get('quantization') == 'int8':
+                quantize_int8(self.pipeline.model)
+
             self.tokenizer = self.pipeline.tokenizer
             self._setup_tokenizer()
+
+            if prefix_cache:
+                self._setup_prefix_cache()
+
+            if static_cache is not None and draft_model is not None:
+                raise ValueError('static_cache and draft_model cannot be combined')
+
+            if static_cache is not None and self.provider == 'local':
+                # Warm up on the thread that runs the model
+                self.executor.submit(self._setup_static_decoder, static_cache).result()
+
+            if draft_model is not None and self.provider == 'local':
+                self._setup_speculative_decoder(draft_model, num_draft_tokens)
+
+            if self.provider == 'local_cb':
+                self.engine = ContinuousBatchingEngine(
+                    self.pipeline.model,
+                    self.tokenizer.pad_token_id,
+                    self.generate_config.get('batch_size', 16)
+                )
+        elif self.provider == 'local_pool':
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model)
+            self._setup_tokenizer()
+            worker_config = dict(worker_config or {})
+            # Replicas only run the model, while completion caching, coalescing and label scoring stay here
+            self.pool = WorkerPool(
+                worker_config.pop('devices', ['cuda']),
+                worker_config.pop('num_threads', None),
+                worker_config.pop('cores', None),
+                task=task,
+                model=model,
+                provider=worker_config.pop('provider', 'local'),
+                endpoint=None,
+                generate_config=generate_config,
+                logp_config=logp_config,
+                prefix_cache=prefix_cache,
+                context_window=context_window,
+                static_cache=static_cache,
+                draft_model=draft_model,
+                num_draft_tokens=num_draft_tokens,
+                cpu_config=cpu_config
+            )
+        elif self.provider == 'daemon':
+            # The daemon runs the model, while templates, caching and coalescing stay in this process
+            self.daemon = DaemonClient(self.endpoint)
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model)
+            self._setup_tokenizer()
+        elif self.provider == 'mock':
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model)
+            self._setup_tokenizer()
+            self.mock = MockBackend(
+                self.tokenizer,
+                labels,
+                batch_size=self.generate_config.get('batch_size', 1),
+                **(mock_config or {})
+            )
         elif self.provider == 'vllm':
-            self.client = AsyncOpenAI(api_key='EMPTY', base_url=f'http://{self.endpoint}/v1')
+            self.limiter = AdaptiveLimiter(**(concurrency_config or {}))
+            self.endpoints = EndpointPool(
+                [self.endpoint] if isinstance(self.endpoint, str) else list(self.endpoint),
+                self.limiter,
+                **(endpoint_config or {})
+            )
             self.tokenizer = AutoTokenizer.from_pretrained(self.model)
             self._setup_tokenizer()
-
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
         else:
             raise ValueError(f'Invalid provider: {self.provider}')
 
+        if context_window is not None:
+            self.tokenizer.model_max_length = context_window
+
     def _setup_tokenizer(self) -> None:
         if self.model == 'microsoft/Phi-4-mini-instruct':
             self.end_tokens = ['<|end|>', '<|endoftext|>']
@@ -61,7 +198,7 @@ class LLM:
             self.tokenizer.pad_token = self.tokenizer.eos_token
             self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
 
-            if self.provider == 'local':
+            if self.provider in ('local', 'local_cb'):
                 self.pipeline.model.generation_config.pad_token_id = self.tokenizer.pad_token_id
 
         if self.model == 'meta-llama/Meta-Llama-3-70B-Instruct':
@@ -69,17 +206,258 @@ class LLM:
 
         self.tokenizer.padding_side = 'left'
 
+    def _setup_prefix_cache(self) -> None:
+        # The system prompt and chat-template header are shared by every templated prompt of the task
+        probes_ids = self.apply_chat_template(['a', 'b'])
+        prefix_cache = PrefixCache(self.pipeline.model, find_shared_prefix(probes_ids))
+
+        # Check the cached path against the uncached one before relying on it
+        probe_prompts = ['Hello, how are you?']
+        probe_targets = ['I am fine, thank you.']
+        uncached_logps = self._compute_target_logps_local(probe_prompts, probe_targets)
+        self.prefix_cache = prefix_cache
+        cached_logps = self._compute_target_logps_local(probe_prompts, probe_targets)
+
+        if torch.allclose(cached_logps, uncached_logps, rtol=1e-2, atol=1e-1):
+            logger.info(f'Cached {len(prefix_cache)} prefix tokens shared by all {self.task} prompts')
+        else:
+            logger.warning(
+                f'Prefix cache disabled: cached log-prob {cached_logps.item()} '
+                f'does not match uncached log-prob {uncached_logps.item()}'
+            )
+            self.prefix_cache = None
+
+    def _setup_static_decoder(self, static_cache: dict) -> None:
+        self.static_decoder = StaticDecoder(
+            self.pipeline.model,
+            self.tokenizer.pad_token_id,
+            self.generate_config.get('batch_size', 1) * self.generate_config.get('num_return_sequences', 1),
+            self.generate_config['max_new_tokens'],
+            static_cache.get('prompt_buckets', [512, 1024, 2048]),
+            static_cache.get('compile', True)
+        )
+
+        # Compile for every bucket now rather than in the middle of the first calls. Beam search bypasses the
+        # static decoder, so it is warmed up for sampling or greedy decoding.
+        self.static_decoder.warmup({
+            key: value for key, value in self.generate_config.items() if key not in ('batch_size', 'num_beams')
+        })
+
+    def _setup_speculative_decoder(self, draft_model: str, num_draft_tokens: int) -> None:
+        if AutoTokenizer.from_pretrained(draft_model).get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f'Draft model {draft_model} must share the tokenizer of {self.model}')
+
+        self.speculative_decoder = SpeculativeDecoder(
+            self.pipeline.model,
+            AutoModelForCausalLM.from_pretrained(draft_model, torch_dtype=self.pipeline.model.dtype).to(
+                self.pipeline.model.device
+            ),
+            num_draft_tokens
+        )
+
     def generate(self, prompts: list[str], apply_template: bool = True, verbose: bool = False) -> (
         list[str] | list[list[str]]
     ):
-        if self.provider == 'local':
-            return self._generate_local(prompts, apply_template, verbose)
+        return self.loop.run_until_complete(self.agenerate(prompts, apply_template, verbose))
+
+    def stream_generate(self, prompts: list[str], apply_template: bool = True, **kwargs) -> (
+        Iterator[tuple[int, str | list[str]]]
+    ):
+        """Synchronous version of `astream_generate`."""
+        return self._iterate(self.astream_generate(prompts, apply_template, **kwargs))
+
+    async def astream_generate(
+        self, prompts: list[str], apply_template: bool = True,
+        chunk_size: int = 64, max_in_flight: int | None = None
+    ) -> AsyncIterator[tuple[int, str | list[str]]]:
+        """Yield `(index, response)` pairs as chunks of `chunk_size` prompts complete, with at most
+        `max_in_flight` chunks being generated and waiting to be consumed at a time."""
+        # Close the stream explicitly, so that its workers stop as soon as the caller stops iterating
+        async with contextlib.aclosing(stream_chunks(
+            len(prompts), chunk_size, max_in_flight or self._default_max_in_flight(),
+            lambda indices: self.agenerate([prompts[index] for index in indices], apply_template)
+        )) as stream:
+            start_time = time.perf_counter()
+
+            async for index, response in stream:
+                if start_time is not None:
+                    self.metrics.record_first_response('generate', time.perf_counter() - start_time)
+                    start_time = None
+
+                yield index, response
+
+    async def agenerate(self, prompts: list[str], apply_template: bool = True, verbose: bool = False) -> (
+        list[str] | list[list[str]]
+    ):
+        start_time = time.perf_counter()
+
+        if self.label_scoring and apply_template:
+            responses = await self._apredict_labels(prompts)
+        else:
+            responses = await self._agenerate_cached(prompts, apply_template, verbose)
+
+        if not self.token_telemetry:
+            self.metrics.record('generate', time.perf_counter() - start_time)
+            return responses
+
+        prompt_lengths = self._count_tokens(prompts)
+        response_lengths = self._count_tokens([
+            response for all_responses in responses
+            for response in ([all_responses] if isinstance(all_responses, str) else all_responses)
+        ])
+        self.metrics.record(
+            'generate', time.perf_counter() - start_time, sum(prompt_lengths), sum(response_lengths)
+        )
+
+        if self.recorder is not None:
+            self.recorder.record(
+                'generate', start_time, prompts, apply_template, prompt_lengths, response_lengths
+            )
+
+        return responses
+
+    async def _agenerate_cached(self, prompts: list[str], apply_template: bool, verbose: bool) -> (
+        list[str] | list[list[str]]
+    ):
+        if self.completion_cache is None or (self._is_stochastic() and not self.cache_stochastic):
+            return await self._agenerate(prompts, apply_template, verbose)
+
+        keys = [
+            self.completion_cache.create_key(
+                model=self.model,
+                provider=self.provider,
+                system_prompt=(SYSTEM_PROMPTS[self.task] if apply_template else None),
+                prompt=prompt,
+                generate_config={
+                    key: value for key, value in self.generate_config.items() if key != 'batch_size'
+                },
+                # Stochastic completions are only reused when opted in, and then as a single fixed draw
+                stochastic=self._is_stochastic()
+            )
+            for prompt in prompts
+        ]
+        responses = self.completion_cache.get(keys)
+        missing_indices = [index for index, response in enumerate(responses) if response is None]
+
+        if missing_indices:
+            missing_prompts = [prompts[index] for index in missing_indices]
+            missing_responses = await self._agenerate(missing_prompts, apply_template, verbose)
+
+            for index, response in zip(missing_indices, missing_responses):
+                responses[index] = response
+
+            self.completion_cache.put({keys[index]: responses[index] for index in missing_indices})
+
+        return responses
+
+    async def _agenerate(self, prompts: list[str], apply_template: bool, verbose: bool) -> (
+        list[str] | list[list[str]]
+    ):
+        if self._is_stochastic() and not self.coalesce_stochastic:
+            # Duplicate prompts must get independent samples, so give every prompt its own key
+            keys = [object() for _ in prompts]
+        else:
+            keys = [(apply_template, prompt) for prompt in prompts]
+
+        if self.provider in ('local', 'local_cb'):
+            # Run the model in its own thread so that the event loop stays responsive
+            return await self.coalescer.run(keys, lambda indices: self._run_local(
+                self._generate_local, [prompts[index] for index in indices], apply_template, verbose
+            ))
+        elif self.provider == 'local_pool':
+            return await self.coalescer.run(keys, lambda indices: self.pool.run(
+                'generate', [prompts[index] for index in indices], apply_template=apply_template
+            ))
+        elif self.provider == 'daemon':
+            return await self.coalescer.run(keys, lambda indices: self.daemon.request(
+                'generate', self.task, dict(self.generate_config), apply_template,
+                prompts=[prompts[index] for index in indices]
+            ))
+        elif self.provider == 'mock':
+            return await self.coalescer.run(keys, lambda indices: self._generate_mock(
+                [prompts[index] for index in indices], apply_template
+            ))
         elif self.provider == 'vllm':
-            return self.loop.run_until_complete(self._generate_api(prompts, apply_template, verbose))
+            return await self.coalescer.run(keys, lambda indices: self._generate_api(
+                [prompts[index] for index in indices], apply_template, verbose
+            ))
+
+    def stats(self) -> dict[str, float]:
+        stats = self.coalescer.stats()
+        stats.update(self.metrics.stats())
+        stats.update({
+            'truncated_prompts': self.num_truncated_prompts,
+            'over_length_prompts': self.num_over_length_prompts
+        })
+
+        for component in [
+            self.speculative_decoder, self.limiter, self.endpoints, self.pool, self.scheduler,
+            self.completion_cache
+        ]:
+            if component is not None:
+                stats.update(component.stats())
+
+        return stats
+
+    async def _run_local(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _count_tokens(self, texts: list[str]) -> list[int]:
+        # Chat templates are left out, so that counts are comparable with and without them
+        return list(map(len, self.tokenizer(texts, add_special_tokens=False)['input_ids'])) if texts else []
+
+    def _iterate(self, stream: AsyncIterator) -> Iterator:
+        try:
+            while True:
+                yield self.loop.run_until_complete(anext(stream))
+        except StopAsyncIteration:
+            return
+        finally:
+            self.loop.run_until_complete(stream.aclose())
+
+    def _default_max_in_flight(self) -> int:
+        # A local model runs one chunk at a time, while a server batches requests from many chunks
+        if self.provider == 'local_pool':
+            return len(self.pool.workers)
+
+        return 1 if self.provider in ('local', 'local_cb', 'mock') else 8
+
+    def _is_stochastic(self) -> bool:
+        if 'do_sample' in self.generate_config:
+            return bool(self.generate_config['do_sample'])
+
+        # The OpenAI-compatible API samples with temperature 1 by default
+        temperature = self.generate_config.get('temperature')
+        return temperature is None or temperature > 0
 
     def _generate_local(self, prompts: list[str], apply_template: bool, verbose: bool) -> (
         list[str] | list[list[str]]
     ):
+        # The decoders below only sample or decode greedily, so beam search falls back to `generate`
+        beam_search = self.generate_config.get('num_beams', 1) > 1
+
+        if self.provider == 'local_cb' and not beam_search:
+            return self._generate_with_decoder(
+                self.engine, self._tokenize_prompts(prompts, apply_template), verbose,
+                prefix_cache=(self.prefix_cache if apply_template else None)
+            )
+
+        if self.speculative_decoder is not None and not beam_search:
+            return self._generate_with_decoder(
+                self.speculative_decoder, self._tokenize_prompts(prompts, apply_template), verbose
+            )
+
+        if self.static_decoder is not None and not beam_search:
+            prompts_ids = self._tokenize_prompts(prompts, apply_template)
+
+            if max(len(prompt_ids) for prompt_ids in prompts_ids) <= self.static_decoder.max_prompt_length:
+                return self._generate_with_decoder(self.static_decoder, prompts_ids, verbose)
+
+            logger.warning('Prompts exceed the largest static cache bucket, so falling back to a dynamic cache')
+
+        if apply_template and self.prefix_cache is not None:
+            return self._generate_local_cached(prompts, verbose)
+
         responses = []
 
         if apply_template:
@@ -115,38 +493,131 @@ class LLM:
 
         return responses
 
+    def _generate_local_cached(self, prompts: list[str], verbose: bool) -> list[str] | list[list[str]]:
+        generate_config = dict(self.generate_config)
+        batch_size = generate_config.pop('batch_size', 1)
+        num_return_sequences = generate_config.get('num_return_sequences', 1)
+
+        # `generate` expands inputs by the number of beams or returned sequences, but not a given cache
+        expand_size = max(generate_config.get('num_beams', 1), num_return_sequences)
+
+        prompts_ids = self.apply_chat_template(prompts)
+        prefix_ids = torch.tensor([self.prefix_cache.prefix_ids], device=self.pipeline.device)
+        responses = []
+
+        with tqdm(total=len(prompts), desc='Generating responses', disable=(not verbose)) as pbar:
+            for start in range(0, len(prompts_ids), batch_size):
+                batch_prompts_ids = prompts_ids[start:start + batch_size]
+
+                if all(self.prefix_cache.matches(prompt_ids) for prompt_ids in batch_prompts_ids):
+                    prefix_length = len(self.prefix_cache)
+                    past_key_values = self.prefix_cache.expand(len(batch_prompts_ids) * expand_size)
+                else:
+                    prefix_length = 0
+                    past_key_values = None
+
+                input_ids, attention_mask, _ = left_pad(
+                    [prompt_ids[prefix_length:] for prompt_ids in batch_prompts_ids],
+                    self.tokenizer.pad_token_id, self.pipeline.device, prefix_length
+                )
+
+                if prefix_length:
+                    input_ids = torch.cat([prefix_ids.expand(len(batch_prompts_ids), -1), input_ids], dim=1)
+
+                with torch.no_grad():
+                    outputs_ids = self.pipeline.model.generate(
+                        input_ids=input_ids,
+                        attention_mask=attention_mask,
+                        past_key_values=past_key_values,
+                        **generate_config
+                    )
+
+                outputs = self.tokenizer.batch_decode(
+                    outputs_ids[:, input_ids.shape[1]:],
+                    skip_special_tokens=True
+                )
+
+                for i in range(len(batch_prompts_ids)):
+                    all_responses = outputs[i * num_return_sequences:(i + 1) * num_return_sequences]
+                    responses.append(all_responses[0] if num_return_sequences == 1 else all_responses)
+
+                pbar.update(len(batch_prompts_ids))
+
+        return responses
+
+    def _generate_with_decoder(
+        self, decoder: ContinuousBatchingEngine | StaticDecoder | SpeculativeDecoder,
+        prompts_ids: list[list[int]], verbose: bool, **kwargs
+    ) -> list[str] | list[list[str]]:
+        generate_config = {key: value for key, value in self.generate_config.items() if key != 'batch_size'}
+
+        with tqdm(desc='Generating responses', total=len(prompts_ids), disable=(not verbose)) as pbar:
+            completions_ids = decoder.generate(
+                prompts_ids,
+                self.end_token_ids,
+                generate_config,
+                callback=lambda _: pbar.update(1),
+                **kwargs
+            )
+
+        return self._decode_completions(completions_ids)
+
+    def _tokenize_prompts(self, prompts: list[str], apply_template: bool) -> list[list[int]]:
+        # Tokenize the same way as the pipeline, i.e. with special tokens for raw text prompts
+        return self.apply_chat_template(prompts) if apply_template else self.tokenizer(prompts)['input_ids']
+
+    def _decode_completions(self, completions_ids: list[list[list[int]]]) -> list[str] | list[list[str]]:
+        responses = []
+
+        for prompt_completions_ids in completions_ids:
+            all_responses = self.tokenizer.batch_decode(prompt_completions_ids, skip_special_tokens=True)
+            responses.append(all_responses[0] if len(all_responses) == 1 else all_responses)
+
+        return responses
+
+    async def _generate_mock(self, prompts: list[str], apply_template: bool) -> list[str] | list[list[str]]:
+        config = self.generate_config
+        completions_ids = await self.mock.generate(
+            self._tokenize_prompts(prompts, apply_template),
+            config.get('max_new_tokens', config.get('max_completion_tokens', config.get('max_tokens', 16))),
+            config.get('num_return_sequences', config.get('n', 1))
+        )
+        return self._decode_completions(completions_ids)
+
     async def _generate_api(self, prompts: list[str], apply_template: bool, verbose: bool) -> (
         list[str] | list[list[str]]
     ):
-        semaphore = asyncio.Semaphore(value=5)
-
         async def _request_response(prompt: str, pbar: tqdm) -> str | list[str]:
             response = None
             num_retries = 0
+            num_ejections = 0
+            # Truncate over-length prompts before sending rather than after the server rejects them
+            prompt = self._fit_context_window(prompt, apply_template)
 
             while response is None:
                 try:
                     if apply_template:
                         message = self._create_message(prompt)
 
-                        async with semaphore:
-                            output = await self.client.chat.completions.create(
-                                messages=message,
-                                model=self.model,
-                                **self.generate_config
-                            )
+                        output = await self.endpoints.call(lambda client: client.chat.completions.create(
+                            messages=message,
+                            model=self.model,
+                            **self.generate_config
+                        ), 'generate')
 
                         if len(output.choices) == 1:
                             response = output.choices[0].message.content
                         elif len(output.choices) > 1:
                             response = [choice.message.content for choice in output.choices]
                     else:
-                        async with semaphore:
-                            output = await self.client.completions.create(
-                                model=self.model,
-                                prompt=prompt,
-                                **self.generate_config
-                            )
+                        output = await self.endpoints.call(lambda client: client.completions.create(
+                            model=self.model,
+                            prompt=(
+                                self.tokenizer.encode(prompt, add_special_tokens=False)
+                                if self.send_token_ids else prompt
+                            ),
+                            **self.generate_config
+                        ), 'generate')
 
                         if len(output.choices) == 1:
                             response = output.choices[0].text
@@ -162,128 +633,445 @@ class LLM:
                             or '\'max_completion_tokens\' is too large:'in err.body['message']
                         )
                     ):
-                        # Truncate messages longer than the model's max length
-                        message_ids = (
-                            self.apply_chat_template([prompt])[0] if apply_template else
-                            self.tokenizer.encode(prompt, add_special_tokens=False)
-                        )
-                        total_length = len(message_ids) + self.generate_config['max_completion_tokens']
+                        # The server's context window is smaller than assumed, so adopt it and truncate again
+                        match = re.search(r'maximum context length is (\d+)', err.body['message'])
 
-                        prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
-                        prompt = self.tokenizer.decode(
-                            prompt_ids[total_length - self.tokenizer.model_max_length:],
-                            skip_special_tokens=True
-                        )
+                        if match is not None and int(match.group(1)) < self.tokenizer.model_max_length:
+                            logger.warning(f'Reducing the context window to {match.group(1)} tokens')
+                            self.tokenizer.model_max_length = int(match.group(1))
+
+                        fitted_prompt = self._fit_context_window(prompt, apply_template)
+
+                        if fitted_prompt != prompt:
+                            prompt = fitted_prompt
+                            continue
+
+                    if isinstance(err, ReplicaEjectedError):
+                        # Another replica can take the request, after a short backoff in case none is healthy
+                        num_ejections += 1
+                        await asyncio.sleep(min(0.1 * 2 ** num_ejections, 10))
                         continue
 
                     logger.error(f'OpenAI API error: {err}', exc_info=True)
                     num_retries += 1
+                    self.metrics.num_retries += 1
                     await asyncio.sleep(min(2 ** num_retries, 60))
 
             return response
 
+        order = self._dispatch_order(prompts)
+
         with tqdm(total=len(prompts), desc='Generating responses', disable=(not verbose)) as pbar:
-            tasks = [asyncio.create_task(_request_response(prompt, pbar)) for prompt in prompts]
-            responses = await asyncio.gather(*tasks)
+            tasks = [asyncio.create_task(_request_response(prompts[index], pbar)) for index in order]
+            ordered_responses = await asyncio.gather(*tasks)
+
+        responses = [None] * len(prompts)
+
+        for index, response in zip(order, ordered_responses):
+            responses[index] = response
 
         return responses
 
     def compute_target_logps(self, prompts: list[str], targets: list[str], apply_template: bool = True) -> (
         torch.Tensor
     ):
-        if self.provider == 'local':
-            return self._compute_target_logps_local(prompts, targets, apply_template)
-        elif self.provider == 'vllm':
-            return self.loop.run_until_complete(
-                self._compute_target_logps_api(prompts, targets, apply_template)
+        return self.loop.run_until_complete(self.acompute_target_logps(prompts, targets, apply_template))
+
+    def stream_target_logps(
+        self, prompts: list[str], targets: list[str], apply_template: bool = True, **kwargs
+    ) -> Iterator[tuple[int, float]]:
+        """Synchronous version of `astream_target_logps`."""
+        return self._iterate(self.astream_target_logps(prompts, targets, apply_template, **kwargs))
+
+    async def astream_target_logps(
+        self, prompts: list[str], targets: list[str], apply_template: bool = True,
+        chunk_size: int = 256, max_in_flight: int | None = None
+    ) -> AsyncIterator[tuple[int, float]]:
+        """Yield `(index, logp)` pairs as chunks of `chunk_size` pairs complete, with at most `max_in_flight`
+        chunks being scored and waiting to be consumed at a time."""
+        async with contextlib.aclosing(stream_chunks(
+            len(prompts), chunk_size, max_in_flight or self._default_max_in_flight(),
+            lambda indices: self.acompute_target_logps(
+                [prompts[index] for index in indices],
+                [targets[index] for index in indices],
+                apply_template
             )
+        )) as stream:
+            start_time = time.perf_counter()
+
+            async for index, logp in stream:
+                if start_time is not None:
+                    self.metrics.record_first_response('logps', time.perf_counter() - start_time)
+                    start_time = None
+
+                yield index, logp.item()
+
+    async def acompute_target_logps(
+        self, prompts: list[str], targets: list[str], apply_template: bool = True
+    ) -> torch.Tensor:
+        start_time = time.perf_counter()
+        keys = [(apply_template, prompt, target) for prompt, target in zip(prompts, targets)]
+
+        if self.provider in ('local', 'local_cb'):
+            logps = await self.coalescer.run(keys, lambda indices: self._run_local(
+                self._compute_target_logps_local,
+                [prompts[index] for index in indices],
+                [targets[index] for index in indices],
+                apply_template
+            ))
+        elif self.provider == 'local_pool':
+            logps = await self.coalescer.run(keys, lambda indices: self.pool.run(
+                'compute_target_logps',
+                [prompts[index] for index in indices],
+                [targets[index] for index in indices],
+                apply_template=apply_template
+            ))
+        elif self.provider == 'daemon':
+            logps = await self.coalescer.run(keys, lambda indices: self.daemon.request(
+                'compute_target_logps', self.task, dict(self.generate_config), apply_template,
+                prompts=[prompts[index] for index in indices],
+                targets=[targets[index] for index in indices]
+            ))
+        elif self.provider == 'mock':
+            logps = await self.coalescer.run(keys, lambda indices: self.mock.compute_target_logps(
+                self._tokenize_pairs(
+                    [prompts[index] for index in indices], [targets[index] for index in indices], apply_template
+                )
+            ))
+        elif self.provider == 'vllm':
+            logps = await self.coalescer.run(keys, lambda indices: self._compute_target_logps_api(
+                [prompts[index] for index in indices],
+                [targets[index] for index in indices],
+                apply_template
+            ))
         else:
             raise ValueError(f'Invalid provider for computing target logps: {self.provider}')
 
+        logps = torch.tensor([float(logp) for logp in logps])
+
+        if not self.token_telemetry:
+            self.metrics.record('logps', time.perf_counter() - start_time)
+            return logps
+
+        prompt_lengths = self._count_tokens(prompts)
+        target_lengths = self._count_tokens(targets)
+        self.metrics.record(
+            'logps', time.perf_counter() - start_time, sum(prompt_lengths), sum(target_lengths)
+        )
+
+        if self.recorder is not None:
+            self.recorder.record(
+                'compute_target_logps', start_time, prompts, apply_template, prompt_lengths, target_lengths,
+                targets
+            )
+
+        return logps
+
+    def score_labels(
+        self, prompts: list[str], labels: list[str] | None = None, apply_template: bool = True
+    ) -> torch.Tensor:
+        return self.loop.run_until_complete(self.ascore_labels(prompts, labels, apply_template))
+
+    async def ascore_labels(
+        self, prompts: list[str], labels: list[str] | None = None, apply_template: bool = True
+    ) -> torch.Tensor:
+        """Return the log-probabilities of `labels` (the `labels` of the LLM by default) for each prompt,
+        normalized over the labels."""
+        labels = labels or self.labels
+
+        if labels is None:
+            raise ValueError(f'No labels given to score for {self.task}')
+
+        if self.provider in ('local', 'local_cb'):
+            labels_logps = await self._run_local(self._score_labels_local, prompts, labels, apply_template)
+        elif self.provider == 'local_pool':
+            labels_logps = await self.pool.run(
+                'score_labels', prompts, labels=labels, apply_template=apply_template
+            )
+        else:
+            # The server's prefix cache shares the prompt between its labels
+            labels_logps = await self.acompute_target_logps(
+                [prompt for prompt in prompts for _ in labels], labels * len(prompts), apply_template
+            )
+            labels_logps = labels_logps.view(len(prompts), len(labels))
+
+        return torch.log_softmax(labels_logps, dim=1)
+
+    async def _apredict_labels(self, prompts: list[str]) -> list[str] | list[list[str]]:
+        labels_logps = await self.ascore_labels(prompts, self.labels)
+        num_return_sequences = self.generate_config.get(
+            'num_return_sequences', self.generate_config.get('n', 1)
+        )
+
+        if self._is_stochastic():
+            # Sample labels from their distribution, warped like that of sampled responses
+            probs = torch.softmax(self._create_label_warpers()(None, labels_logps.float()), dim=1)
+            indices = torch.multinomial(probs, num_return_sequences, replacement=True)
+        else:
+            indices = labels_logps.argmax(dim=1, keepdim=True).expand(-1, num_return_sequences)
+
+        return [
+            self.labels[row[0]] if num_return_sequences == 1 else [self.labels[index] for index in row]
+            for row in indices.tolist()
+        ]
+
+    def _create_label_warpers(self) -> LogitsProcessorList:
+        if self.provider in ('local', 'local_cb'):
+            # Fall back on the model's generation defaults, as `generate` does
+            return create_warpers(
+                create_generation_config(self.pipeline.model, {**self.generate_config, 'do_sample': True})
+            )
+
+        # The OpenAI-compatible API applies no top-k
+        return create_warpers(GenerationConfig(do_sample=True, top_k=None, **{
+            key: self.generate_config[key] for key in ('temperature', 'top_p') if key in self.generate_config
+        }))
+
+    def _score_labels_local(self, prompts: list[str], labels: list[str], apply_template: bool) -> torch.Tensor:
+        pairs_ids = self._tokenize_pairs(
+            [prompt for prompt in prompts for _ in labels], labels * len(prompts), apply_template
+        )
+        labels_logps = torch.zeros(len(prompts), len(labels), dtype=torch.float)
+
+        for i in range(len(prompts)):
+            prompt_pairs_ids = pairs_ids[i * len(labels):(i + 1) * len(labels)]
+            prompt_ids = prompt_pairs_ids[0][0]
+
+            # Prefill the prompt once and score all labels on top of its cache in one batch. The last prompt
+            # token stays out of the cache, since its hidden state predicts the first label token.
+            prompt_cache = PrefixCache(self.pipeline.model, prompt_ids[:-1]) if len(prompt_ids) > 1 else None
+            labels_logps[i] = self._compute_micro_batch_logps(prompt_pairs_ids, prompt_cache)
+
+        return labels_logps
+
     def _compute_target_logps_local(
         self, prompts: list[str], targets: list[str], apply_template: bool = True
     ) -> torch.Tensor:
-        if apply_template:
-            inputs_ids = self.apply_chat_template(prompts)
-            targets_ids = self.tokenizer(targets, add_special_tokens=False)['input_ids']
-            targets_ids = [target_ids + self.end_token_ids for target_ids in targets_ids]
-        else:
-            inputs_ids = self.tokenizer(prompts, add_special_tokens=False)['input_ids']
-            targets_ids = self.tokenizer(targets, add_special_tokens=False)['input_ids']
+        pairs_ids = self._tokenize_pairs(prompts, targets, apply_template)
 
-        target_logps = []
-        model_max_length = self.tokenizer.model_max_length
+        # Pairs whose prompt starts with the cached prefix only run their remaining tokens through the model
+        prefix_length = len(self.prefix_cache) if self.prefix_cache is not None else 0
+        cached_indices = [
+            index for index, (input_ids, _) in enumerate(pairs_ids)
+            if prefix_length and self.prefix_cache.matches(input_ids)
+        ]
+        uncached_indices = sorted(set(range(len(pairs_ids))) - set(cached_indices))
 
-        for input_ids, target_ids in zip(inputs_ids, targets_ids):
-            if len(input_ids) + len(target_ids) > model_max_length:
-                target_max_length = model_max_length - len(input_ids)
-                assert target_max_length > 0
-                target_ids = target_ids[:target_max_length]
+        target_logps = torch.zeros(len(pairs_ids), dtype=torch.float)
 
-            concat_ids = input_ids + target_ids
-            concat_ids = torch.tensor([concat_ids], device=self.pipeline.device)
-            labels = concat_ids[:, 1:]
+        for prefix_cache, indices in [(self.prefix_cache, cached_indices), (None, uncached_indices)]:
+            micro_batches = plan_micro_batches(
+                [
+                    sum(map(len, pairs_ids[index])) - (len(prefix_cache) if prefix_cache is not None else 0)
+                    for index in indices
+                ],
+                self.logp_config.get('max_batch_tokens', 16384)
+            )
 
-            with torch.no_grad():
-                outputs = self.pipeline.model(input_ids=concat_ids)
+            for micro_batch in micro_batches:
+                micro_batch = [indices[i] for i in micro_batch]
+                target_logps[micro_batch] = self._compute_micro_batch_logps(
+                    [pairs_ids[index] for index in micro_batch], prefix_cache
+                )
 
-            logps = torch.log_softmax(outputs.logits[:, :-1, :], dim=2)
-            token_logps = logps.gather(dim=2, index=labels.unsqueeze(dim=2)).squeeze(dim=2)
-            token_mask = torch.zeros_like(token_logps)
-            token_mask[0, -len(target_ids):] = 1.
+        return target_logps
 
-            target_logp = torch.sum(token_logps * token_mask, dim=1)
-            target_logps.append(target_logp)
+    def _compute_micro_batch_logps(
+        self, pairs_ids: list[tuple[list[int], list[int]]], prefix_cache: PrefixCache | None
+    ) -> torch.Tensor:
+        """Compute target log-probs of `pairs_ids`, whose prompts start with the prefix of `prefix_cache` if
+        given."""
+        prefix_length = len(prefix_cache) if prefix_cache is not None else 0
+        concats_ids = [input_ids[prefix_length:] + target_ids for input_ids, target_ids in pairs_ids]
+        target_lengths = torch.tensor([len(target_ids) for _, target_ids in pairs_ids])
+        input_ids, attention_mask, position_ids = left_pad(
+            concats_ids, self.tokenizer.pad_token_id, self.pipeline.device, prefix_length
+        )
+        past_key_values = prefix_cache.expand(len(pairs_ids)) if prefix_length else None
 
-        return torch.cat(target_logps, dim=0)
+        with torch.no_grad():
+            # Run the decoder only and project hidden states at the target span through the LM head,
+            # instead of materializing full-vocabulary logits at every prompt position
+            hidden_states = self.pipeline.model.get_decoder()(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=False
+            ).last_hidden_state
+
+            # Left padding aligns every target span to the end of the sequence
+            span_length = max(target_lengths.max().item(), 1)
+            labels = input_ids[:, -span_length:]
+            token_logps = compute_token_logps(
+                hidden_states[:, -span_length - 1:-1, :],
+                labels,
+                self.pipeline.model.get_output_embeddings(),
+                self.logp_config.get('vocab_chunk_size', 32768)
+            )
+
+        token_mask = torch.arange(span_length) >= span_length - target_lengths.unsqueeze(dim=1)
+        return torch.sum(token_logps.cpu() * token_mask, dim=1)
 
     async def _compute_target_logps_api(
         self, prompts: list[str], targets: list[str], apply_template: bool = True
     ) -> torch.Tensor:
-        semaphore = asyncio.Semaphore(value=5)
-
-        async def _request_logp(prompt: str, target_length: int) -> float:
-            logp = None
+        async def _request_logps(concats: list[str] | list[list[int]], target_lengths: list[int]) -> (
+            list[float]
+        ):
+            logps = None
             num_retries = 0
+            num_ejections = 0
 
-            while logp is None:
+            while logps is None:
                 try:
-                    async with semaphore:
-                        output = await self.client.completions.create(
-                            model=self.model,
-                            prompt=prompt,
-                            echo=True,
-                            logprobs=0,
-                            max_tokens=0
-                        )
+                    # The completions endpoint scores a list of prompts in one request
+                    output = await self.endpoints.call(lambda client: client.completions.create(
+                        model=self.model,
+                        prompt=concats,
+                        echo=True,
+                        logprobs=0,
+                        max_tokens=0
+                    ), 'logps')
+
+                    logps = [0.] * len(concats)
 
-                    logps = output.choices[0].logprobs.token_logprobs
-                    logp = sum(logps[-target_length:])
+                    for choice in output.choices:
+                        token_logps = choice.logprobs.token_logprobs
+                        logps[choice.index] = sum(token_logps[-target_lengths[choice.index]:])
                 except OpenAIError as err:
                     if (
                         isinstance(err.body, dict)
                         and 'Please reduce the length of the input messages.' in err.body['message']
                     ):
-                        return 0.
+                        if len(concats) == 1:
+                            return [0.]
+
+                        # Score prompts one by one so that only the over-length ones get a zero log-prob
+                        all_logps = await asyncio.gather(*[
+                            _request_logps([concat], [target_length])
+                            for concat, target_length in zip(concats, target_lengths)
+                        ])
+                        return [logp for logps in all_logps for logp in logps]
+
+                    if isinstance(err, ReplicaEjectedError):
+                        num_ejections += 1
+                        await asyncio.sleep(min(0.1 * 2 ** num_ejections, 10))
+                        continue
 
                     logger.error(f'VLLM API error: {err}', exc_info=True)
                     num_retries += 1
+                    self.metrics.num_retries += 1
                     await asyncio.sleep(min(2 ** num_retries, 60))
 
-            return logp
+            return logps
 
-        if apply_template:
-            prompts = self.apply_chat_template(prompts, tokenize=False)
-            targets = [target + ''.join(self.end_tokens) for target in targets]
+        if self.send_token_ids:
+            # Token IDs spare the server from re-tokenizing and make target spans exact
+            pairs_ids = self._tokenize_pairs(prompts, targets, apply_template)
+            concats_ids = [input_ids + target_ids for input_ids, target_ids in pairs_ids]
+            concats = concats_ids
+            target_lengths = [len(target_ids) for _, target_ids in pairs_ids]
+        else:
+            if apply_template:
+                prompts = self.apply_chat_template(prompts, tokenize=False)
+                targets = [target + ''.join(self.end_tokens) for target in targets]
+
+            concats = [prompt + target for prompt, target in zip(prompts, targets)]
+            concats_ids = self.tokenizer(concats, add_special_tokens=False)['input_ids']
+            targets_ids = self.tokenizer(targets, add_special_tokens=False)['input_ids']
+            target_lengths = [len(target_ids) for target_ids in targets_ids]
 
-        concats = [prompt + target for prompt, target in zip(prompts, targets)]
-        target_lengths = [len(self.tokenizer.encode(target, add_special_tokens=False)) for target in targets]
+        # The server would reject over-length prompts, so give them a zero log-prob without sending them
+        sent_indices = [
+            index for index, concat_ids in enumerate(concats_ids)
+            if len(concat_ids) <= self.tokenizer.model_max_length
+        ]
+        self.num_over_length_prompts += len(concats_ids) - len(sent_indices)
+
+        order = [sent_indices[position] for position in self._dispatch_order(
+            [concats_ids[index] for index in sent_indices]
+        )]
+        requests = plan_requests(
+            [len(concats_ids[index]) for index in order],
+            self.logp_config.get('max_request_tokens', 32768),
+            self.logp_config.get('max_request_prompts', 64)
+        )
+        requests = [[order[position] for position in request] for request in requests]
         tasks = [
-            asyncio.create_task(_request_logp(concat, target_length))
-            for concat, target_length in zip(concats, target_lengths)
+            asyncio.create_task(_request_logps(
+                [concats[index] for index in request],
+                [target_lengths[index] for index in request]
+            ))
+            for request in requests
         ]
-        logps = await asyncio.gather(*tasks)
-        return torch.tensor(logps)
+        all_logps = await asyncio.gather(*tasks)
+
+        target_logps = torch.zeros(len(concats), dtype=torch.float)
+
+        for request, logps in zip(requests, all_logps):
+            target_logps[request] = torch.tensor(logps, dtype=torch.float)
+
+        return target_logps
+
+    def _fit_context_window(self, prompt: str, apply_template: bool) -> str:
+        """Truncate the start of `prompt` so that it fits in the context window along with the completion."""
+        max_new_tokens = (
+            self.generate_config.get('max_completion_tokens') or self.generate_config.get('max_tokens') or 0
+        )
+        truncated = False
+
+        while True:
+            message_ids = (
+                self.apply_chat_template([prompt])[0] if apply_template else
+                self.tokenizer.encode(prompt, add_special_tokens=False)
+            )
+            excess_length = len(message_ids) + max_new_tokens - self.tokenizer.model_max_length
+
+            if excess_length <= 0:
+                break
+
+            prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
+
+            if not prompt_ids:
+                break
+
+            # Re-encoding the decoded text may merge tokens differently, so check the length again
+            prompt = self.tokenizer.decode(prompt_ids[excess_length:], skip_special_tokens=True)
+            truncated = True
+
+        self.num_truncated_prompts += truncated
+        return prompt
+
+    def _dispatch_order(self, sequences: list[str] | list[list[int]]) -> list[int]:
+        if self.scheduler is None:
+            return list(range(len(sequences)))
+
+        return self.scheduler.order(sequences)
+
+    def _tokenize_pairs(self, prompts: list[str], targets: list[str], apply_template: bool) -> (
+        list[tuple[list[int], list[int]]]
+    ):
+        if apply_template:
+            inputs_ids = self.apply_chat_template(prompts)
+            targets_ids = self.tokenizer(targets, add_special_tokens=False)['input_ids']
+            targets_ids = [target_ids + self.end_token_ids for target_ids in targets_ids]
+        else:
+            inputs_ids = self.tokenizer(prompts, add_special_tokens=False)['input_ids']
+            targets_ids = self.tokenizer(targets, add_special_tokens=False)['input_ids']
+
+        pairs_ids = []
+        model_max_length = self.tokenizer.model_max_length
+
+        for input_ids, target_ids in zip(inputs_ids, targets_ids):
+            if len(input_ids) + len(target_ids) > model_max_length:
+                target_max_length = model_max_length - len(input_ids)
+                assert target_max_length > 0
+                target_ids = target_ids[:target_max_length]
+
+            pairs_ids.append((input_ids, target_ids))
+
+        return pairs_ids
 
     def apply_chat_template(self, prompts: list[str], tokenize: bool = True) -> list[str] | list[list[int]]:
         return self.tokenizer.apply_chat_template(
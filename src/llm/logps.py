@@ -0,0 +1,25 @@
+import torch
+import torch.nn as nn
+
+
+def compute_token_logps(
+    hidden_states: torch.Tensor, labels: torch.Tensor, lm_head: nn.Linear, vocab_chunk_size: int
+) -> torch.Tensor:
+    """Compute log-probabilities of `labels` by projecting `hidden_states` through `lm_head` one vocabulary
+    chunk at a time, so that only a (num_tokens, vocab_chunk_size) block of logits exists at any moment."""
+    flat_hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+    flat_labels = labels.reshape(-1)
+
+    label_logits = torch.zeros_like(flat_labels, dtype=torch.float)
+    logsumexp = torch.full_like(label_logits, fill_value=-float('inf'))
+
+    for start in range(0, lm_head.out_features, vocab_chunk_size):
+        end = min(start + vocab_chunk_size, lm_head.out_features)
+        chunk_bias = lm_head.bias[start:end] if lm_head.bias is not None else None
+        chunk_logits = nn.functional.linear(flat_hidden_states, lm_head.weight[start:end], chunk_bias).float()
+        logsumexp = torch.logaddexp(logsumexp, torch.logsumexp(chunk_logits, dim=1))
+
+        in_chunk = (flat_labels >= start) & (flat_labels < end)
+        label_logits[in_chunk] = chunk_logits[in_chunk, flat_labels[in_chunk] - start]
+
+    return (label_logits - logsumexp).view_as(labels)
@@ -0,0 +1,75 @@
+import asyncio
+import random
+import zlib
+
+from transformers import PreTrainedTokenizerBase
+
+
+class MockBackend:
+    """Stands in for a model with deterministic pseudo-responses and log-probs, so that everything around the
+    LLM can be run and profiled without one.
+
+    Responses and log-probs are drawn from a generator seeded with the prompt's token IDs, so repeated calls
+    agree. Responses are `labels` of the task if given, and random tokens of the real tokenizer otherwise.
+    A call takes `time_per_prompt_token` per prompt token plus `time_per_output_token` per decoding step,
+    where the sequences of a batch of `batch_size` prompts are decoded together.
+    """
+
+    def __init__(
+        self, tokenizer: PreTrainedTokenizerBase, labels: list[str] | None = None,
+        time_per_prompt_token: float = 0., time_per_output_token: float = 0., batch_size: int = 1
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.labels_ids = (
+            [tokenizer.encode(label, add_special_tokens=False) for label in labels] if labels else None
+        )
+        self.time_per_prompt_token = time_per_prompt_token
+        self.time_per_output_token = time_per_output_token
+        self.batch_size = batch_size
+        # Special tokens would be dropped when decoding, so only sample regular ones
+        self.token_ids = sorted(set(range(tokenizer.vocab_size)) - set(tokenizer.all_special_ids))
+
+    async def generate(
+        self, prompts_ids: list[list[int]], max_new_tokens: int, num_return_sequences: int = 1
+    ) -> list[list[list[int]]]:
+        completions_ids = []
+
+        for prompt_ids in prompts_ids:
+            rng = _create_rng(prompt_ids)
+            completions_ids.append([
+                rng.choice(self.labels_ids) if self.labels_ids is not None
+                else rng.choices(self.token_ids, k=rng.randint(1, max_new_tokens))
+                for _ in range(num_return_sequences)
+            ])
+
+        num_decode_steps = 0
+
+        for start in range(0, len(completions_ids), self.batch_size):
+            num_decode_steps += max(
+                len(completion_ids)
+                for all_ids in completions_ids[start:start + self.batch_size] for completion_ids in all_ids
+            )
+
+        await self._wait(sum(map(len, prompts_ids)), num_decode_steps)
+        return completions_ids
+
+    async def compute_target_logps(self, pairs_ids: list[tuple[list[int], list[int]]]) -> list[float]:
+        logps = []
+
+        for input_ids, target_ids in pairs_ids:
+            rng = _create_rng(input_ids + target_ids)
+            logps.append(-sum(rng.random() * 5 for _ in target_ids))
+
+        # Scoring is a single forward pass over prompts and targets
+        await self._wait(sum(len(input_ids) + len(target_ids) for input_ids, target_ids in pairs_ids), 0)
+        return logps
+
+    async def _wait(self, num_prompt_tokens: int, num_decode_steps: int) -> None:
+        delay = num_prompt_tokens * self.time_per_prompt_token + num_decode_steps * self.time_per_output_token
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _create_rng(token_ids: list[int]) -> random.Random:
+    return random.Random(zlib.crc32(str(token_ids).encode()))
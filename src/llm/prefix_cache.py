@@ -0,0 +1,45 @@
+import torch
+from transformers import PreTrainedModel
+from transformers.cache_utils import DynamicCache
+
+
+class PrefixCache:
+    """KV cache of a token prefix shared by many prompts, computed once and reused across calls."""
+
+    def __init__(self, model: PreTrainedModel, prefix_ids: list[int]) -> None:
+        self.prefix_ids = prefix_ids
+
+        # Run the decoder only, since the logits of the prefix are never used
+        with torch.no_grad():
+            outputs = model.get_decoder()(
+                input_ids=torch.tensor([prefix_ids], device=model.device), use_cache=True
+            )
+
+        self.key_values = outputs.past_key_values.to_legacy_cache()
+
+    def __len__(self) -> int:
+        return len(self.prefix_ids)
+
+    def matches(self, input_ids: list[int]) -> bool:
+        """Check whether `input_ids` starts with the cached prefix and has at least one token after it."""
+        return len(input_ids) > len(self.prefix_ids) and input_ids[:len(self.prefix_ids)] == self.prefix_ids
+
+    def expand(self, batch_size: int) -> DynamicCache:
+        """Create a fresh cache holding the prefix for `batch_size` sequences without copying it."""
+        return DynamicCache.from_legacy_cache(tuple(
+            (keys.expand(batch_size, -1, -1, -1), values.expand(batch_size, -1, -1, -1))
+            for keys, values in self.key_values
+        ))
+
+
+def find_shared_prefix(sequences: list[list[int]]) -> list[int]:
+    """Find the longest token prefix shared by all `sequences`."""
+    prefix_length = 0
+
+    while (
+        all(prefix_length < len(sequence) for sequence in sequences)
+        and len({sequence[prefix_length] for sequence in sequences}) == 1
+    ):
+        prefix_length += 1
+
+    return sequences[0][:prefix_length]
@@ -0,0 +1,55 @@
+import json
+import time
+from pathlib import Path
+
+
+class CallRecorder:
+    """Appends every `generate` and `compute_target_logps` call of an `LLM` to a JSONL file, for replay
+    against a stand-in server with `benchmark.py replay`.
+
+    The first line describes the LLM, and each following one a call: its arrival time in seconds since the
+    recorder was created, its prompts (and targets), and the token lengths of its prompts and responses.
+    """
+
+    def __init__(self, path: str, task: str, model: str, provider: str, generate_config: dict) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, 'w')
+        self.start_time = time.perf_counter()
+        self._write({
+            'task': task,
+            'model': model,
+            'provider': provider,
+            'generate_config': {key: value for key, value in generate_config.items() if key != 'batch_size'}
+        })
+
+    def record(
+        self, method: str, start_time: float, prompts: list[str], apply_template: bool,
+        prompt_lengths: list[int], response_lengths: list[int], targets: list[str] | None = None
+    ) -> None:
+        call = {
+            'time': start_time - self.start_time,
+            'latency': time.perf_counter() - start_time,
+            'method': method,
+            'apply_template': apply_template,
+            'prompts': prompts,
+            'prompt_lengths': prompt_lengths,
+            'response_lengths': response_lengths
+        }
+
+        if targets is not None:
+            call['targets'] = targets
+
+        self._write(call)
+
+    def _write(self, line: dict) -> None:
+        # Flush every line, so that the recording of a crashed run is still usable
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
+
+
+def load_recording(path: str) -> tuple[dict, list[dict]]:
+    """Return the LLM description and the calls of a recording."""
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+
+    return lines[0], lines[1:]
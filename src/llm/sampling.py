@@ -0,0 +1,47 @@
+import copy
+
+import torch
+from transformers import (
+    GenerationConfig, LogitsProcessorList, PreTrainedModel,
+    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+)
+
+
+def create_generation_config(model: PreTrainedModel, generate_config: dict) -> GenerationConfig:
+    """Override the model's generation defaults with `generate_config`, as `generate` does."""
+    config = copy.deepcopy(model.generation_config)
+    config.update(**generate_config)
+    return config
+
+
+def get_stop_token_ids(config: GenerationConfig, stop_token_ids: list[int]) -> list[int]:
+    """Combine `stop_token_ids` with the EOS tokens of the generation config, which `generate` stops at."""
+    eos_token_ids = config.eos_token_id if isinstance(config.eos_token_id, list) else [config.eos_token_id]
+    return sorted(set(stop_token_ids) | {token_id for token_id in eos_token_ids if token_id is not None})
+
+
+def create_warpers(config: GenerationConfig) -> LogitsProcessorList:
+    # Same warpers and order as `generate`, so that sampling follows the same distribution
+    warpers = LogitsProcessorList()
+
+    if not config.do_sample:
+        return warpers
+
+    if config.temperature is not None and config.temperature != 1.:
+        warpers.append(TemperatureLogitsWarper(config.temperature))
+
+    if config.top_k is not None and config.top_k != 0:
+        warpers.append(TopKLogitsWarper(config.top_k))
+
+    if config.top_p is not None and config.top_p < 1.:
+        warpers.append(TopPLogitsWarper(config.top_p))
+
+    return warpers
+
+
+def sample_tokens(logits: torch.Tensor, do_sample: bool, warpers: LogitsProcessorList) -> torch.Tensor:
+    if not do_sample:
+        return torch.argmax(logits, dim=-1)
+
+    probs = torch.softmax(warpers(None, logits.float()), dim=-1)
+    return torch.multinomial(probs, num_samples=1).squeeze(dim=1)
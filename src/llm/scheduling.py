@@ -0,0 +1,34 @@
+from typing import Sequence
+
+
+class PrefixScheduler:
+    """Orders requests so that those sharing a prefix are dispatched back to back, which lets the server's
+    prefix cache reuse the shared part while it is still resident."""
+
+    def __init__(self) -> None:
+        self.shared_length = 0
+        self.total_length = 0
+
+    def order(self, sequences: list[Sequence]) -> list[int]:
+        """Return the dispatch order of `sequences` (token IDs or text)."""
+        # In lexicographic order, the longest prefix a sequence shares with any earlier one is the one shared
+        # with its predecessor, so sorting both groups prefixes and makes the sharing estimate exact
+        order = sorted(range(len(sequences)), key=lambda index: sequences[index])
+
+        for prev_index, index in zip(order, order[1:]):
+            self.shared_length += _common_prefix_length(sequences[prev_index], sequences[index])
+
+        self.total_length += sum(len(sequence) for sequence in sequences)
+        return order
+
+    def stats(self) -> dict[str, float]:
+        return {'prefix_sharing_ratio': self.shared_length / self.total_length if self.total_length else 0.}
+
+
+def _common_prefix_length(a: Sequence, b: Sequence) -> int:
+    length = 0
+
+    while length < min(len(a), len(b)) and a[length] == b[length]:
+        length += 1
+
+    return length
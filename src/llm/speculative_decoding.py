@@ -0,0 +1,157 @@
+from typing import Callable
+
+import torch
+from transformers import LogitsProcessorList, PreTrainedModel
+from transformers.cache_utils import DynamicCache
+
+from .sampling import create_generation_config, create_warpers, get_stop_token_ids
+
+
+class SpeculativeDecoder:
+    """Generates with speculative decoding, where a small draft model proposes `num_draft_tokens` tokens that
+    the target model verifies in a single forward pass.
+
+    Draft tokens are accepted with probability min(1, p / q) under the target and draft distributions p and
+    q, and the first rejected one is resampled from the normalized max(0, p - q). Completions thus follow the
+    target model's distribution exactly, and match its greedy ones without sampling. Sequences are decoded
+    one at a time, since the number of accepted tokens differs between them.
+    """
+
+    def __init__(self, model: PreTrainedModel, draft_model: PreTrainedModel, num_draft_tokens: int = 4) -> None:
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        # Vocabularies may be padded to different sizes, but only the tokenizer's tokens are ever sampled
+        self.vocab_size = min(model.config.vocab_size, draft_model.config.vocab_size)
+
+        self.num_proposed = 0
+        self.num_accepted = 0
+        self.num_target_steps = 0
+        self.num_generated = 0
+
+    @torch.no_grad()
+    def generate(
+        self, prompts_ids: list[list[int]], stop_token_ids: list[int], generate_config: dict,
+        callback: Callable[[int], None] | None = None
+    ) -> list[list[list[int]]]:
+        """Generate `num_return_sequences` completions per prompt and return their token IDs without stop
+        tokens. `callback` is called with the index of each prompt whose completions are all finished."""
+        config = create_generation_config(self.model, generate_config)
+
+        if config.num_beams > 1:
+            raise ValueError('Speculative decoding does not support beam search')
+
+        warpers = create_warpers(config)
+        stop_token_ids = set(get_stop_token_ids(config, stop_token_ids))
+        completions_ids = []
+
+        for index, prompt_ids in enumerate(prompts_ids):
+            max_new_tokens = config.max_new_tokens or config.max_length - len(prompt_ids)
+            completions_ids.append([
+                self._generate_sequence(prompt_ids, stop_token_ids, max_new_tokens, config.do_sample, warpers)
+                for _ in range(config.num_return_sequences)
+            ])
+
+            if callback is not None:
+                callback(index)
+
+        return completions_ids
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'draft_acceptance_rate': self.num_accepted / self.num_proposed if self.num_proposed else 0.,
+            # Upper bound on the speedup, reached when drafting is free
+            'tokens_per_target_step': (
+                self.num_generated / self.num_target_steps if self.num_target_steps else 0.
+            )
+        }
+
+    def _generate_sequence(
+        self, prompt_ids: list[int], stop_token_ids: set[int], max_new_tokens: int,
+        do_sample: bool, warpers: LogitsProcessorList
+    ) -> list[int]:
+        device = self.model.device
+        tokens = list(prompt_ids)
+        # The target cache holds all tokens but the last one, and the draft cache the first `draft_length`
+        cache = DynamicCache()
+        draft_cache = DynamicCache()
+        draft_length = 0
+
+        if len(tokens) > 1:
+            self.model(
+                input_ids=torch.tensor([tokens[:-1]], device=device), past_key_values=cache, use_cache=True
+            )
+
+        completion_ids = []
+
+        while len(completion_ids) < max_new_tokens:
+            # Propose draft tokens, keeping one token of the budget for the target's own token
+            num_draft_tokens = min(self.num_draft_tokens, max_new_tokens - len(completion_ids) - 1)
+            draft_ids = []
+            draft_probs = []
+            input_ids = tokens[draft_length:]
+
+            for _ in range(num_draft_tokens):
+                logits = self.draft_model(
+                    input_ids=torch.tensor([input_ids], device=device),
+                    past_key_values=draft_cache,
+                    use_cache=True
+                ).logits[0, -1:, :self.vocab_size]
+                probs = self._get_probs(logits, do_sample, warpers)
+                draft_ids.append(torch.multinomial(probs, num_samples=1).item())
+                draft_probs.append(probs[0])
+                input_ids = [draft_ids[-1]]
+
+            if num_draft_tokens > 0:
+                draft_length = len(tokens) + num_draft_tokens - 1
+
+            # Score the last token and all draft tokens at once, which yields one more distribution than drafts
+            logits = self.model(
+                input_ids=torch.tensor([tokens[-1:] + draft_ids], device=device),
+                past_key_values=cache,
+                use_cache=True
+            ).logits[0, :, :self.vocab_size]
+            probs = self._get_probs(logits, do_sample, warpers)
+
+            num_accepted = 0
+
+            for i, draft_id in enumerate(draft_ids):
+                if torch.rand(1).item() * draft_probs[i][draft_id] >= probs[i, draft_id]:
+                    break
+
+                num_accepted += 1
+
+            if num_accepted < len(draft_ids):
+                residual_probs = torch.clamp(probs[num_accepted] - draft_probs[num_accepted], min=0)
+                next_id = torch.multinomial(residual_probs / residual_probs.sum(), num_samples=1).item()
+            else:
+                next_id = torch.multinomial(probs[num_accepted], num_samples=1).item()
+
+            new_ids = draft_ids[:num_accepted] + [next_id]
+            self.num_proposed += len(draft_ids)
+            self.num_accepted += num_accepted
+            self.num_target_steps += 1
+
+            # Roll back the caches past the rejected draft tokens
+            cache.crop(len(tokens) + num_accepted)
+            draft_length = min(draft_length, len(tokens) + num_accepted)
+            draft_cache.crop(draft_length)
+            tokens += new_ids
+
+            for new_id in new_ids:
+                if new_id in stop_token_ids:
+                    self.num_generated += len(completion_ids)
+                    return completion_ids
+
+                completion_ids.append(new_id)
+
+        self.num_generated += len(completion_ids)
+        return completion_ids
+
+    @staticmethod
+    def _get_probs(logits: torch.Tensor, do_sample: bool, warpers: LogitsProcessorList) -> torch.Tensor:
+        # Without sampling, both models are deterministic, so draft tokens are accepted iff they are the argmax
+        if not do_sample:
+            return torch.nn.functional.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+
+        return torch.softmax(warpers(None, logits.float()), dim=-1)
@@ -0,0 +1,225 @@
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from transformers import PreTrainedTokenizerBase
+
+
+logger = logging.getLogger(__name__)
+
+
+class StandInServer:
+    """OpenAI-compatible stand-in for a vLLM server, returning synthetic responses after modelled delays.
+
+    It serves `/v1/chat/completions`, `/v1/completions` (including echoed prompt log-probs for scoring) and
+    `/v1/models`. A request holds one of `max_batch_size` slots, queueing when all are taken, for `latency`
+    plus its prompt tokens at `prefill_tokens_per_second` plus `time_per_output_token` per response token,
+    scaled by log-normal noise of scale `jitter`.
+
+    Responses are `max_tokens` tokens long, or, given `response_lengths` (e.g. those of a recording), a
+    length drawn from them by a hash of the prompt. Tokens are counted with `tokenizer`, or as words without
+    one. Prompts over `max_model_len` tokens are rejected with vLLM's error message.
+    """
+
+    def __init__(
+        self, host: str = '127.0.0.1', port: int = 0, tokenizer: PreTrainedTokenizerBase | None = None,
+        max_batch_size: int = 256, latency: float = 0.02, prefill_tokens_per_second: float = 20000.,
+        time_per_output_token: float = 0.02, jitter: float = 0.1, response_lengths: list[int] | None = None,
+        max_model_len: int | None = None
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.latency = latency
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.time_per_output_token = time_per_output_token
+        self.jitter = jitter
+        self.response_lengths = response_lengths
+        self.max_model_len = max_model_len
+
+        self.slots = threading.BoundedSemaphore(max_batch_size)
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_running = 0
+        self.max_running = 0
+        self.queue_time = 0.
+
+        self.server = ThreadingHTTPServer((host, port), _create_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'{host}:{port}'
+
+    def start(self) -> 'StandInServer':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'server_requests': self.num_requests,
+            'server_max_running': self.max_running,
+            'server_mean_queue_time': self.queue_time / self.num_requests if self.num_requests else 0.
+        }
+
+    def complete(self, endpoint: str, body: dict) -> tuple[int, dict]:
+        """Return the status code and body of the response to a request."""
+        if endpoint == 'chat':
+            prompts = ['\n'.join(message['content'] for message in body['messages'])]
+        elif isinstance(body['prompt'], str) or (body['prompt'] and isinstance(body['prompt'][0], int)):
+            prompts = [body['prompt']]
+        else:
+            prompts = body['prompt']
+
+        prompts_ids = [self._tokenize(prompt) for prompt in prompts]
+        max_tokens = body.get('max_completion_tokens', body.get('max_tokens'))
+        max_tokens = 16 if max_tokens is None else max_tokens
+        num_choices = body.get('n', 1)
+
+        for prompt_ids in prompts_ids:
+            if self.max_model_len is not None and len(prompt_ids) + max_tokens > self.max_model_len:
+                return 400, {
+                    'object': 'error',
+                    'type': 'BadRequestError',
+                    'message': (
+                        f'This model\'s maximum context length is {self.max_model_len} tokens. However, you '
+                        f'requested {len(prompt_ids) + max_tokens} tokens. Please reduce the length of the '
+                        f'input messages.'
+                    ),
+                    'code': 400
+                }
+
+        choices = []
+        num_prompt_tokens = 0
+        num_completion_tokens = 0
+
+        for i, (prompt, prompt_ids) in enumerate(zip(prompts, prompts_ids)):
+            rng = random.Random(zlib.crc32(json.dumps(prompt).encode()))
+            num_prompt_tokens += len(prompt_ids)
+
+            for j in range(num_choices):
+                num_tokens = max_tokens
+
+                if self.response_lengths and max_tokens > 0:
+                    num_tokens = min(rng.choice(self.response_lengths), max_tokens)
+
+                text = self._synthesize(rng, num_tokens)
+                num_completion_tokens += num_tokens
+                choice = {'index': i * num_choices + j, 'finish_reason': 'length', 'logprobs': None}
+
+                if endpoint == 'chat':
+                    choice['message'] = {'role': 'assistant', 'content': text}
+                else:
+                    choice['text'] = text
+
+                    if body.get('echo') and body.get('logprobs') is not None:
+                        # The first token has no log-prob, like in vLLM
+                        token_logprobs = [None] + [-rng.random() * 5 for _ in prompt_ids[1:]]
+                        choice['logprobs'] = {
+                            'tokens': [str(token) for token in prompt_ids],
+                            'token_logprobs': token_logprobs,
+                            'top_logprobs': None,
+                            'text_offset': [0] * len(prompt_ids)
+                        }
+
+                choices.append(choice)
+
+        self._simulate(num_prompt_tokens, num_completion_tokens // max(len(prompts) * num_choices, 1))
+        return 200, {
+            'id': f'cmpl-{self.num_requests}',
+            'object': 'chat.completion' if endpoint == 'chat' else 'text_completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': choices,
+            'usage': {
+                'prompt_tokens': num_prompt_tokens,
+                'completion_tokens': num_completion_tokens,
+                'total_tokens': num_prompt_tokens + num_completion_tokens
+            }
+        }
+
+    def _simulate(self, num_prompt_tokens: int, num_output_tokens: int) -> None:
+        start_time = time.perf_counter()
+
+        with self.slots:
+            with self.lock:
+                self.num_requests += 1
+                self.num_running += 1
+                self.max_running = max(self.max_running, self.num_running)
+                self.queue_time += time.perf_counter() - start_time
+
+            # Sequences of a batch decode in parallel, so a request's time depends on its own length only
+            delay = (
+                self.latency
+                + num_prompt_tokens / self.prefill_tokens_per_second
+                + num_output_tokens * self.time_per_output_token
+            )
+            time.sleep(delay * random.lognormvariate(0., self.jitter))
+
+            with self.lock:
+                self.num_running -= 1
+
+    def _tokenize(self, prompt: str | list[int]) -> list[int] | list[str]:
+        if not isinstance(prompt, str):
+            return prompt
+
+        if self.tokenizer is None:
+            return prompt.split()
+
+        return self.tokenizer.encode(prompt, add_special_tokens=False)
+
+    def _synthesize(self, rng: random.Random, num_tokens: int) -> str:
+        if self.tokenizer is None:
+            return ' '.join(rng.choice(_WORDS) for _ in range(num_tokens))
+
+        # Random token IDs decode to text of about `num_tokens` tokens
+        return self.tokenizer.decode(
+            [rng.randrange(self.tokenizer.vocab_size) for _ in range(num_tokens)], skip_special_tokens=True
+        )
+
+
+_WORDS = ['the', 'a', 'user', 'likes', 'movie', 'paper', 'review', 'good', 'new', 'story', 'of', 'and']
+
+
+def _create_handler(server: StandInServer) -> type[BaseHTTPRequestHandler]:
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections alive, like the client's connection pool expects
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self) -> None:
+            if self.path.rstrip('/') == '/v1/models':
+                self._respond(200, {'object': 'list', 'data': [{'id': 'stand-in', 'object': 'model'}]})
+            else:
+                self._respond(404, {'message': f'Not found: {self.path}'})
+
+        def do_POST(self) -> None:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+            if self.path == '/v1/chat/completions':
+                self._respond(*server.complete('chat', body))
+            elif self.path == '/v1/completions':
+                self._respond(*server.complete('completions', body))
+            else:
+                self._respond(404, {'message': f'Not found: {self.path}'})
+
+        def log_message(self, format: str, *args) -> None:
+            logger.debug(format % args)
+
+        def _respond(self, status: int, body: dict) -> None:
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return Handler
@@ -0,0 +1,151 @@
+from typing import Callable
+
+import torch
+from transformers import LogitsProcessorList, PreTrainedModel
+from transformers.cache_utils import StaticCache
+
+from .sampling import create_generation_config, create_warpers, get_stop_token_ids, sample_tokens
+
+
+class StaticDecoder:
+    """Generates with a preallocated static KV cache and compiled forward passes.
+
+    Prompts are left-padded to the smallest of `prompt_buckets` that fits them and batches are filled up to
+    `batch_size` rows, so that the compiled forward pass sees one input shape per bucket for prefill and a
+    single one for decoding. Call `warmup` to compile all of them ahead of the first real batch.
+    """
+
+    def __init__(
+        self, model: PreTrainedModel, pad_token_id: int, batch_size: int, max_new_tokens: int,
+        prompt_buckets: list[int], compile: bool = True
+    ) -> None:
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.prompt_buckets = sorted(prompt_buckets)
+        self.cache = StaticCache(
+            config=model.config,
+            max_batch_size=batch_size,
+            max_cache_len=self.prompt_buckets[-1] + max_new_tokens,
+            device=model.device,
+            dtype=model.dtype
+        )
+
+        if compile:
+            # CUDA graphs remove the remaining per-step launch overhead, but only exist on GPUs
+            mode = 'reduce-overhead' if model.device.type == 'cuda' else None
+            self.forward = torch.compile(model.forward, mode=mode, fullgraph=True, dynamic=False)
+        else:
+            self.forward = model.forward
+
+    @property
+    def max_prompt_length(self) -> int:
+        return self.prompt_buckets[-1]
+
+    def warmup(self, generate_config: dict) -> None:
+        """Compile the prefill of every bucket and the decode step."""
+        for bucket in self.prompt_buckets:
+            self.generate([[self.pad_token_id] * bucket], [], dict(generate_config, max_new_tokens=2))
+
+    @torch.no_grad()
+    def generate(
+        self, prompts_ids: list[list[int]], stop_token_ids: list[int], generate_config: dict,
+        callback: Callable[[int], None] | None = None
+    ) -> list[list[list[int]]]:
+        """Generate `num_return_sequences` completions per prompt and return their token IDs without stop
+        tokens. `callback` is called with the index of each prompt whose completions are all finished."""
+        config = create_generation_config(self.model, generate_config)
+
+        if config.num_beams > 1:
+            raise ValueError('Static decoding does not support beam search')
+
+        num_return_sequences = config.num_return_sequences
+        max_new_tokens = min(config.max_new_tokens or self.max_new_tokens, self.max_new_tokens)
+        warpers = create_warpers(config)
+        stop_token_ids = torch.tensor(get_stop_token_ids(config, stop_token_ids), device=self.model.device)
+
+        # Batch rows of similar lengths together, so that they fall in the same bucket
+        rows = [(index, i) for index in range(len(prompts_ids)) for i in range(num_return_sequences)]
+        rows.sort(key=lambda row: len(prompts_ids[row[0]]), reverse=True)
+        completions_ids = [[None] * num_return_sequences for _ in prompts_ids]
+        num_unfinished = [num_return_sequences] * len(prompts_ids)
+
+        for start in range(0, len(rows), self.batch_size):
+            batch_rows = rows[start:start + self.batch_size]
+            batch_completions_ids = self._generate_batch(
+                [prompts_ids[index] for index, _ in batch_rows],
+                stop_token_ids, max_new_tokens, config.do_sample, warpers
+            )
+
+            for (index, i), completion_ids in zip(batch_rows, batch_completions_ids):
+                completions_ids[index][i] = completion_ids
+                num_unfinished[index] -= 1
+
+                if num_unfinished[index] == 0 and callback is not None:
+                    callback(index)
+
+        return completions_ids
+
+    def _generate_batch(
+        self, rows_ids: list[list[int]], stop_token_ids: torch.Tensor, max_new_tokens: int,
+        do_sample: bool, warpers: LogitsProcessorList
+    ) -> list[list[int]]:
+        num_rows = len(rows_ids)
+        bucket = min(bucket for bucket in self.prompt_buckets if bucket >= max(map(len, rows_ids)))
+        # Fill the batch with copies of the first row, whose completions are dropped
+        rows_ids = rows_ids + [rows_ids[0]] * (self.batch_size - num_rows)
+
+        input_ids = torch.full((self.batch_size, bucket), fill_value=self.pad_token_id, dtype=torch.long)
+        # The mask spans the whole cache, so that decode steps keep the same shape
+        attention_mask = torch.zeros((self.batch_size, self.cache.max_cache_len), dtype=torch.long)
+
+        for i, row_ids in enumerate(rows_ids):
+            input_ids[i, bucket - len(row_ids):] = torch.tensor(row_ids, dtype=torch.long)
+            attention_mask[i, bucket - len(row_ids):bucket] = 1
+
+        input_ids = input_ids.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+        position_ids = (attention_mask[:, :bucket].cumsum(dim=1) - 1).clamp(min=0)
+
+        self.cache.reset()
+        logits = self.forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            cache_position=torch.arange(bucket, device=self.model.device),
+            use_cache=True,
+            logits_to_keep=1
+        ).logits[:, -1, :]
+
+        completions_ids = [[] for _ in range(num_rows)]
+        finished = [False] * num_rows
+        position_ids = position_ids[:, -1:]
+
+        for step in range(max_new_tokens):
+            next_tokens = sample_tokens(logits, do_sample, warpers)
+            stopped = torch.isin(next_tokens, stop_token_ids).tolist()
+
+            for i, token in enumerate(next_tokens[:num_rows].tolist()):
+                if not finished[i]:
+                    finished[i] = stopped[i]
+
+                    if not stopped[i]:
+                        completions_ids[i].append(token)
+
+            if all(finished) or step == max_new_tokens - 1:
+                break
+
+            attention_mask[:, bucket + step] = 1
+            position_ids = position_ids + 1
+            logits = self.forward(
+                input_ids=next_tokens.unsqueeze(dim=1),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.cache,
+                cache_position=torch.tensor([bucket + step], device=self.model.device),
+                use_cache=True
+            ).logits[:, -1, :]
+
+        return completions_ids
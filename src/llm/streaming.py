@@ -0,0 +1,49 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Sequence
+
+
+async def stream_chunks(
+    num_items: int, chunk_size: int, max_in_flight: int,
+    fn: Callable[[list[int]], Awaitable[Sequence[Any]]]
+) -> AsyncIterator[tuple[int, Any]]:
+    """Run `fn` on chunks of item indices and yield `(index, result)` pairs as chunks complete.
+
+    At most `max_in_flight` workers pull chunks from a queue, and finished chunks wait in a queue of the same
+    size until consumed, so a slow consumer stalls new work instead of piling up results in memory.
+    """
+    chunks = asyncio.Queue()
+
+    for start in range(0, num_items, chunk_size):
+        chunks.put_nowait(list(range(start, min(start + chunk_size, num_items))))
+
+    num_chunks = chunks.qsize()
+    results = asyncio.Queue(maxsize=max_in_flight)
+
+    async def worker() -> None:
+        while not chunks.empty():
+            chunk = chunks.get_nowait()
+
+            try:
+                chunk_results = await fn(chunk)
+            except Exception as err:
+                await results.put((chunk, err))
+                return
+
+            await results.put((chunk, chunk_results))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(max_in_flight, num_chunks))]
+
+    try:
+        for _ in range(num_chunks):
+            chunk, chunk_results = await results.get()
+
+            if isinstance(chunk_results, Exception):
+                raise chunk_results
+
+            for index, result in zip(chunk, chunk_results):
+                yield index, result
+    finally:
+        for worker_task in workers:
+            worker_task.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,69 @@
+from collections import defaultdict, deque
+
+
+class CallMetrics:
+    """Per-call telemetry of an `LLM`: call counts, token counts, throughput, and latency percentiles over the
+    last `window_size` calls of each kind (e.g. `generate`, `logps`).
+
+    Time to first response is recorded for streaming calls, as the time until their first result is ready.
+    Token counts and throughput are only reported for kinds of calls recorded with token counts.
+    """
+
+    def __init__(self, window_size: int = 1000) -> None:
+        self.window_size = window_size
+        self.num_calls = defaultdict(int)
+        self.num_prompt_tokens = defaultdict(int)
+        self.num_completion_tokens = defaultdict(int)
+        self.total_time = defaultdict(float)
+        self.latencies = defaultdict(lambda: deque(maxlen=self.window_size))
+        self.first_response_latencies = defaultdict(lambda: deque(maxlen=self.window_size))
+        self.num_retries = 0
+
+    def record(
+        self, kind: str, latency: float, num_prompt_tokens: int | None = None, num_completion_tokens: int = 0
+    ) -> None:
+        self.num_calls[kind] += 1
+        self.latencies[kind].append(latency)
+
+        if num_prompt_tokens is not None:
+            self.num_prompt_tokens[kind] += num_prompt_tokens
+            self.num_completion_tokens[kind] += num_completion_tokens
+            self.total_time[kind] += latency
+
+    def record_first_response(self, kind: str, latency: float) -> None:
+        self.first_response_latencies[kind].append(latency)
+
+    def stats(self) -> dict[str, float]:
+        stats = {'retries': self.num_retries}
+
+        for kind, num_calls in self.num_calls.items():
+            stats[f'{kind}_calls'] = num_calls
+
+            if kind in self.num_prompt_tokens:
+                num_tokens = self.num_prompt_tokens[kind] + self.num_completion_tokens[kind]
+                stats.update({
+                    f'{kind}_prompt_tokens': self.num_prompt_tokens[kind],
+                    f'{kind}_completion_tokens': self.num_completion_tokens[kind],
+                    f'{kind}_tokens_per_second': (
+                        num_tokens / self.total_time[kind] if self.total_time[kind] else 0.
+                    )
+                })
+
+            stats.update(_percentiles(f'{kind}_latency', self.latencies[kind]))
+
+        for kind, latencies in self.first_response_latencies.items():
+            stats.update(_percentiles(f'{kind}_first_response_latency', latencies))
+
+        return stats
+
+
+def _percentiles(name: str, latencies: deque[float]) -> dict[str, float]:
+    latencies = sorted(latencies)
+
+    if not latencies:
+        return {}
+
+    return {
+        f'{name}_p{percentile}': latencies[min(len(latencies) * percentile // 100, len(latencies) - 1)]
+        for percentile in (50, 95, 99)
+    }
@@ -0,0 +1,180 @@
+import asyncio
+import atexit
+import itertools
+import logging
+import os
+import queue
+import threading
+from typing import Any
+
+import torch
+import torch.multiprocessing as mp
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """Runs one local `LLM` replica per device in its own process and shards calls across them.
+
+    A call splits its inputs into one contiguous shard per worker and concatenates the shards' results, so
+    they come back in input order. Tensors are returned through shared memory rather than pickled. For CPU
+    socket groups, list `cpu` once per group and give the cores of each group in `cores`, to which its worker
+    is pinned. `num_threads` defaults to the number of cores of a worker.
+    """
+
+    def __init__(
+        self, devices: list[str], num_threads: int | None = None, cores: list[list[int]] | None = None,
+        **llm_kwargs
+    ) -> None:
+        if cores is not None and len(cores) != len(devices):
+            raise ValueError(f'Expected one core list per device, got {len(cores)} for {len(devices)} devices')
+
+        # CUDA cannot be reinitialized in forked processes
+        context = mp.get_context('spawn')
+        self.responses = context.Queue()
+        self.requests = [context.Queue() for _ in devices]
+        self.workers = [
+            context.Process(
+                target=_run_worker,
+                args=(
+                    rank, device, num_threads, cores[rank] if cores is not None else None, llm_kwargs,
+                    self.requests[rank], self.responses
+                ),
+                daemon=True
+            )
+            for rank, device in enumerate(devices)
+        ]
+
+        for worker in self.workers:
+            worker.start()
+
+        # Wait for every replica to load, so that loading errors surface here
+        for _ in self.workers:
+            rank, error = self.responses.get()
+
+            if error is not None:
+                self.close()
+                raise RuntimeError(f'Worker {rank} on {devices[rank]} failed to load the model') from error
+
+        self.call_ids = itertools.count()
+        self.pending: dict[int, tuple[int, asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self.lock = threading.Lock()
+        self.num_calls = 0
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+        atexit.register(self.close)
+
+    async def run(self, method: str, *args: list, **kwargs) -> list | torch.Tensor:
+        """Call `method` of the replicas on shards of the lists `args`, and return the concatenated results.
+        `kwargs` are passed to every shard."""
+        self.num_calls += 1
+        num_inputs = len(args[0])
+        shard_size = max(-(-num_inputs // len(self.workers)), 1)
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        for rank, start in enumerate(range(0, num_inputs, shard_size)):
+            future = loop.create_future()
+
+            with self.lock:
+                call_id = next(self.call_ids)
+                self.pending[call_id] = (rank, loop, future)
+
+            self.requests[rank].put((
+                call_id, method, [arg[start:start + shard_size] for arg in args], kwargs
+            ))
+            futures.append(future)
+
+        results = await asyncio.gather(*futures)
+
+        if results and isinstance(results[0], torch.Tensor):
+            return torch.cat(results)
+
+        return [output for result in results for output in result]
+
+    def stats(self) -> dict[str, int]:
+        return {'pool_workers': sum(worker.is_alive() for worker in self.workers), 'pool_calls': self.num_calls}
+
+    def close(self) -> None:
+        for requests, worker in zip(self.requests, self.workers):
+            if worker.is_alive():
+                requests.put(None)
+
+        for worker in self.workers:
+            worker.join(timeout=10)
+
+            if worker.is_alive():
+                worker.terminate()
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                call_id, output, error = self.responses.get(timeout=1.)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+            except (EOFError, OSError):
+                return
+
+            with self.lock:
+                _, loop, future = self.pending.pop(call_id)
+
+            loop.call_soon_threadsafe(_resolve, future, output, error)
+
+    def _fail_dead_workers(self) -> None:
+        with self.lock:
+            for call_id, (rank, loop, future) in list(self.pending.items()):
+                if not self.workers[rank].is_alive():
+                    del self.pending[call_id]
+                    error = RuntimeError(f'Worker {rank} exited with code {self.workers[rank].exitcode}')
+                    loop.call_soon_threadsafe(_resolve, future, None, error)
+
+
+def _resolve(future: asyncio.Future, output: Any, error: BaseException | None) -> None:
+    if future.cancelled():
+        return
+
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(output)
+
+
+def _run_worker(
+    rank: int, device: str, num_threads: int | None, cores: list[int] | None, llm_kwargs: dict,
+    requests: mp.Queue, responses: mp.Queue
+) -> None:
+    # Imported here, since the pool itself is created by `LLM`
+    from .llm import LLM
+
+    if cores is not None:
+        # Pin the worker before loading, so that its weights are allocated in the memory of its socket
+        os.sched_setaffinity(0, cores)
+        num_threads = num_threads or len(cores)
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    try:
+        llm = LLM(**llm_kwargs, device=device)
+    except Exception as err:
+        responses.put((rank, err))
+        return
+
+    responses.put((rank, None))
+
+    while (request := requests.get()) is not None:
+        call_id, method, args, kwargs = request
+
+        try:
+            output = getattr(llm, method)(*args, **kwargs)
+        except Exception as err:
+            logger.error(f'Worker {rank} failed on {method}: {err}', exc_info=True)
+            responses.put((call_id, None, err))
+            continue
+
+        if isinstance(output, torch.Tensor):
+            output.share_memory_()
+
+        responses.put((call_id, output, None))
@@ -0,0 +1,25 @@
+import logging
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from llm.daemon import ModelDaemon
+
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(config_path='../conf', config_name='daemon', version_base=None)
+def main(cfg: DictConfig) -> None:
+    # Check for missing keys
+    missing_keys = OmegaConf.missing_keys(cfg)
+
+    if missing_keys:
+        raise ValueError(f'Missing keys in config:\n{missing_keys}')
+
+    daemon = ModelDaemon(cfg.socket_path, cfg.max_batch_size, cfg.max_wait, task=cfg.task, **cfg.llm)
+    daemon.serve()
+
+
+if __name__ == '__main__':
+    main()
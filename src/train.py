@@ -20,7 +20,7 @@ from bandit_ramp import (
     create_reward,
     load_retrieved_lamp_dataset
 )
-from lamp import create_metric, create_prompt_generator
+from lamp import LABELED_TASKS, create_metric, create_prompt_generator, get_labels
 from llm import LLM
 
 
@@ -61,7 +61,7 @@ def main(cfg: DictConfig) -> None:
         score_model.from_pretrained(f'./models/{cfg.exp_name}')
         logger.info(f'Loaded model from {f"./models/{cfg.exp_name}"}')
 
-    llm = LLM(cfg.task, **cfg.llm)
+    llm = LLM(cfg.task, **cfg.llm, labels=(get_labels(cfg.task) if cfg.task in LABELED_TASKS else None))
 
     # Prepare datasets
     test_split = ('dev' if cfg.task.startswith('LaMP') else 'test')